@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Measure how long it takes to import crosscap and its parts, with python -X importtime
+
+    python bench/bench_import.py [--repeat 10] [--save baseline.json] [--baseline baseline.json]
+
+Each import runs in a fresh interpreter. For each module we report the median and best cumulative
+import time, and which of the optional heavy dependencies it pulled in.
+"""
+from __future__ import print_function
+
+import json
+import subprocess
+import sys
+
+import click
+
+
+TARGETS = (
+    'crosscap',
+    'crosscap.tree',
+    'crosscap.permitting',
+    'crosscap.openapi',
+    'crosscap.urltool',
+)
+
+# dependencies that only the OpenAPI and urltool features need
+HEAVY = ('yaml', 'click', 'ftfy', 'pkg_resources')
+
+DEFAULT_REPEAT = 10
+
+DEFAULT_TOLERANCE = 0.10
+
+
+def importTime(module):
+    """
+    Import module in a new interpreter
+
+    -> (cumulative microseconds, set of the names of all modules imported)
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative = None
+    imported = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, total, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            cumulative = int(total)
+    return cumulative, imported
+
+
+def measure(module, repeat):
+    """
+    -> dict of the median and best import times of module, in microseconds, and the heavy modules it imported
+    """
+    times = []
+    for n in range(repeat):
+        cumulative, imported = importTime(module)
+        times.append(cumulative)
+    times.sort()
+    return {
+        'median': times[len(times) // 2],
+        'best': times[0],
+        'heavy': sorted(m for m in HEAVY if m in imported),
+    }
+
+
+@click.command()
+@click.option('--repeat', default=DEFAULT_REPEAT, help='Import each module this many times')
+@click.option('--baseline', type=click.Path(dir_okay=False), help='Compare with results saved in this file')
+@click.option('--save', type=click.Path(dir_okay=False), help='Save the results to this file')
+@click.option('--tolerance', default=DEFAULT_TOLERANCE, help='Fraction slower than the baseline that counts as a regression')
+def main(repeat, baseline, save, tolerance):
+    """
+    Measure the import time of crosscap modules, optionally against a baseline
+    """
+    saved = {}
+    if baseline:
+        with open(baseline) as f:
+            saved = json.load(f)
+
+    results = {}
+    regressed = []
+    click.echo('{:<24} {:>12} {:>12} {:>9}  {}'.format('module', 'median ms', 'best ms', 'vs base', 'heavy imports'))
+    for module in TARGETS:
+        result = results[module] = measure(module, repeat)
+        change = ''
+        if module in saved:
+            ratio = float(result['median']) / saved[module]['median']
+            change = '{:+.1%}'.format(ratio - 1)
+            if ratio > 1 + tolerance:
+                change += ' !'
+                regressed.append(module)
+        click.echo('{:<24} {:>12.1f} {:>12.1f} {:>9}  {}'.format(
+            module, result['median'] / 1000., result['best'] / 1000., change, ' '.join(result['heavy'])))
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if regressed:
+        raise click.ClickException('{} regressed: {}'.format(len(regressed), ', '.join(regressed)))
+
+
+if __name__ == '__main__':
+    main()
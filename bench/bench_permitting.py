@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the permitting hot path: permits, validate_token, extract_bearer_token and
+create_timed_token
+
+    python bench/bench_permitting.py [--filter 'permits*'] [--save baseline.json] [--baseline baseline.json]
+
+Requests are built with crosscap.testing.request and pass through Klein-shaped handlers (a method
+taking the request) and Tornado-shaped handlers (a method of a handler object holding the request),
+the way an application would use them. Everything runs offline.
+"""
+from itertools import cycle
+
+from builtins import object
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import jwt
+
+from klein import Klein
+
+from twisted.python import components
+
+from crosscap import permitting
+from crosscap.testing import DummyRequest, request
+
+from harness import Bench
+
+
+SECRET = 'a benchmark secret, long enough for HS256'
+
+RULE_COUNTS = (1, 5, 10)
+
+# more distinct tokens than the cache can hold, so every lookup misses
+MISS_TOKENS = 64
+MISS_CACHE_SIZE = 16
+
+
+def _rsa_keys():
+    """
+    -> (private key, public key PEM)
+    """
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    public = private.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private, public
+
+
+class Auth(object):
+    """
+    How to verify the tokens of one benchmark
+    """
+    def __init__(self, key, algorithm, cache=None):
+        self.key = key
+        self.algorithm = algorithm
+        self.cache = cache
+
+    def validate(self, token):
+        return permitting.validate_token(token, self.key, None, cache=self.cache, algorithms=[self.algorithm])
+
+
+class User(object):
+    def __init__(self, sub):
+        self.userID = sub
+        self.roles = ['role%d' % n for n in range(max(RULE_COUNTS))]
+
+
+class BenchAuthUser(object):
+    """
+    An ICurrentUser that reads a bearer token from the request
+    """
+    def __init__(self, req):
+        self.req = req
+
+    def authenticate(self):
+        token = permitting.extract_bearer_token(self.req.getHeader('authorization'))
+        payload = self.req.auth.validate(token)
+        return payload and User(payload['sub'])
+
+    def authenticated(self, user):
+        self.user = user
+        return user
+
+    def forbidden(self):
+        return 'forbidden'
+
+    @property
+    def roles(self):
+        return self.user.roles
+
+components.registerAdapter(BenchAuthUser, DummyRequest, permitting.ICurrentUser)
+
+
+class TornadoHandler(object):
+    """
+    Shaped like a tornado.web.RequestHandler
+    """
+    def __init__(self, request):
+        self.request = request
+
+
+class TornadoAuthUser(BenchAuthUser):
+    def __init__(self, handler):
+        BenchAuthUser.__init__(self, handler.request)
+
+components.registerAdapter(TornadoAuthUser, TornadoHandler, permitting.ICurrentUser)
+
+
+def _rules(count):
+    return [permitting.role_in(['role%d' % n]) for n in range(count)]
+
+
+def kleinPage(count):
+    """
+    -> a Klein app instance whose 'resource' route is protected by count rules
+    """
+    class Page(object):
+        app = Klein()
+
+        @app.route('/resource')
+        @permitting.permits(*_rules(count))
+        def resource(self, request):
+            return 'ok'
+
+    return Page()
+
+
+def tornadoHandler(count):
+    """
+    -> a Tornado-shaped handler class whose get() is protected by count rules
+    """
+    class Handler(TornadoHandler):
+        @permitting.permits(*_rules(count))
+        def get(self):
+            return 'ok'
+
+    return Handler
+
+
+def _fresh(req):
+    """
+    Make req look like a new request to permits(), which remembers the user on the request
+
+    -> req
+    """
+    req.__dict__.pop('_crosscap_cache', None)
+    return req
+
+
+def bearer(token):
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return request([], requestHeaders=[('authorization', ['Bearer ' + token])])
+
+
+def addTokenBenchmarks(bench, keys):
+    private, public = keys
+
+    header = 'Bearer ' + permitting.create_timed_token('bench-user', SECRET)
+    bench.add('extract_bearer_token', lambda: permitting.extract_bearer_token(header))
+
+    bench.add('create_timed_token HS256', lambda: permitting.create_timed_token('bench-user', SECRET))
+
+    for algorithm, signing, verifying in [('HS256', SECRET, SECRET), ('RS256', private, public)]:
+        token = jwt.encode({'sub': 'bench-user'}, signing, algorithm=algorithm)
+        tokens = cycle([jwt.encode({'sub': 'user%d' % n}, signing, algorithm=algorithm) for n in range(MISS_TOKENS)])
+
+        nocache = Auth(verifying, algorithm)
+        hit = Auth(verifying, algorithm, permitting.TokenCache())
+        miss = Auth(verifying, algorithm, permitting.TokenCache(maxsize=MISS_CACHE_SIZE))
+
+        bench.add('validate_token {} no cache'.format(algorithm), lambda auth=nocache, t=token: auth.validate(t))
+        bench.add('validate_token {} cache hit'.format(algorithm), lambda auth=hit, t=token: auth.validate(t))
+        bench.add('validate_token {} cache miss'.format(algorithm), lambda auth=miss, ts=tokens: auth.validate(next(ts)))
+
+
+def addPermitsBenchmarks(bench, keys):
+    private, public = keys
+
+    scenarios = [
+        ('HS256 cache hit', SECRET, Auth(SECRET, 'HS256', permitting.TokenCache())),
+        ('HS256 no cache', SECRET, Auth(SECRET, 'HS256')),
+        ('RS256 cache hit', private, Auth(public, 'RS256', permitting.TokenCache())),
+        ('RS256 no cache', private, Auth(public, 'RS256')),
+    ]
+    for label, signing, auth in scenarios:
+        algorithm = auth.algorithm
+        req = bearer(jwt.encode({'sub': 'bench-user'}, signing, algorithm=algorithm))
+        req.auth = auth
+
+        for count in RULE_COUNTS:
+            page = kleinPage(count)
+            klein = lambda page=page, req=req: page.app.execute_endpoint('resource', _fresh(req))
+            assert klein() == 'ok'
+            bench.add('permits klein {} {} rules'.format(label, count), klein)
+
+            # tornado makes a new handler for every request
+            tornado = lambda cls=tornadoHandler(count), req=req: cls(req).get()
+            assert tornado() == 'ok'
+            bench.add('permits tornado {} {} rules'.format(label, count), tornado)
+
+    # an unrecognized token is forbidden
+    forged = bearer(jwt.encode({'sub': 'bench-user'}, 'not the secret, but just as long as it is', algorithm='HS256'))
+    forged.auth = Auth(SECRET, 'HS256', permitting.TokenCache())
+    page = kleinPage(1)
+    forbidden = lambda: page.app.execute_endpoint('resource', _fresh(forged))
+    assert forbidden() == 'forbidden'
+    bench.add('permits klein HS256 forbidden', forbidden)
+
+
+def build():
+    bench = Bench()
+    keys = _rsa_keys()
+    addTokenBenchmarks(bench, keys)
+    addPermitsBenchmarks(bench, keys)
+    return bench
+
+
+if __name__ == '__main__':
+    build().main()
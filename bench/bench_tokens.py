@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Compare create_timed_tokens against calling create_timed_token in a loop
+
+    python bench/bench_tokens.py [COUNT]
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+
+from crosscap import permitting
+
+
+SECRET = 'a benchmark secret, long enough for HS256'
+
+
+def looped(subs):
+    return [permitting.create_timed_token(sub, SECRET) for sub in subs]
+
+
+def bulk(subs, verify=1):
+    return list(permitting.create_timed_tokens(subs, SECRET, verify=verify))
+
+
+def main(count=1000):
+    subs = ['service-account-%d' % n for n in range(count)]
+    cases = [
+        ('create_timed_token, looped', lambda: looped(subs)),
+        ('create_timed_tokens', lambda: bulk(subs)),
+        ('create_timed_tokens, verify=0', lambda: bulk(subs, verify=0)),
+    ]
+    baseline = None
+    for label, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=5))
+        baseline = baseline or best
+        print('{:<32} {:>10.0f} tokens/s {:>6.2f}x'.format(label, count / best, baseline / best))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Benchmarks for dispatching requests through a tree of enter() apps, and through the same tree
+compiled with crosscap.tree.flatten, with and without a RouteCache
+
+    python bench/bench_tree.py [--filter 'flat*'] [--save baseline.json] [--baseline baseline.json]
+
+Each request is rendered by a KleinResource, as twisted.web would, for a leaf endpoint 0 to
+MAX_DEPTH branches deep.
+"""
+from builtins import object
+
+from klein import Klein
+
+from twisted.web import server
+from twisted.web.test.test_web import DummyChannel
+
+from crosscap import tree
+
+from harness import Bench
+
+
+MAX_DEPTH = 5
+
+
+def _level(n):
+    """
+    -> a class with a /leaf route, and a /next/ branch entering the next level down
+    """
+    class Level(object):
+        app = Klein()
+
+        @app.route('/leaf')
+        def leaf(self, request):
+            return 'leaf'
+
+        if n < MAX_DEPTH:
+            @app.route('/next/', branch=True)
+            @tree.enter('{}.Level{}'.format(__name__, n + 1))
+            def descend(self, request, subKlein):
+                return subKlein
+
+    Level.__name__ = 'Level{}'.format(n)
+    return Level
+
+
+for _n in range(MAX_DEPTH + 1):
+    globals()['Level{}'.format(_n)] = _level(_n)
+
+
+def render(resource, path):
+    """
+    Render a GET request for path with resource, -> the response
+    """
+    req = server.Request(DummyChannel(), False)
+    transport = req.channel.transport
+    req.method = b'GET'
+    req.uri = req.path = path
+    req.prepath = []
+    req.postpath = path.split(b'/')[1:]
+    req.client, req.host = transport.getPeer(), transport.getHost()
+    req.gotLength(0)
+    req.requestHeaders.setRawHeaders(b'host', [b'localhost'])
+    resource.render(req)
+    return transport.written.getvalue()
+
+
+def build():
+    bench = Bench()
+    root = globals()['Level0']()
+    resources = [
+        ('tree', root.app.resource()),
+        ('flat', tree.flatten(root.__class__, root).resource()),
+        ('flat cached', tree.flatten(root.__class__, root, cache=tree.RouteCache()).resource()),
+    ]
+    for label, resource in resources:
+        for depth in range(MAX_DEPTH + 1):
+            path = b'/next' * depth + b'/leaf'
+            assert render(resource, path).endswith(b'\r\n\r\nleaf')
+            bench.add('{} depth {}'.format(label, depth), lambda resource=resource, path=path: render(resource, path))
+    return bench
+
+
+if __name__ == '__main__':
+    build().main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Benchmarks for building and writing the OpenAPI spec of a large synthetic enter() tree, as yaml
+and as JSON
+
+    python bench/bench_urltool.py [--filter 'write*'] [--save baseline.json] [--baseline baseline.json]
+
+The tree has SUBAPPS sub-apps of ROUTES routes each, every route documented with a docstring,
+some yaml in the docstring, and openAPIDoc metadata. The "pure python" benchmark parses docstrings
+without libyaml, for comparison.
+"""
+from builtins import object
+
+from klein import Klein
+
+from mock import patch
+
+from crosscap import openapi, tree, urltool, yamlhack
+from crosscap.doccache import DocCache
+
+from harness import Bench
+
+
+SUBAPPS = 30
+ROUTES = 100
+
+
+def _subApp(n):
+    """
+    -> a class with ROUTES documented routes
+    """
+    class Sub(object):
+        app = Klein()
+
+    for r in range(ROUTES):
+        def handler(self, request, thingID): # pragma: nocover
+            return 'thing'
+
+        handler.__name__ = 'thing{}'.format(r)
+        handler.__doc__ = """
+        Get thing {r} of sub-app {n}
+
+        Things are returned in their entirety, and there is a
+        long description of them here.
+        ---
+        tags: [sub{n}]
+        x-thing: {r}
+        """.format(n=n, r=r)
+        handler = tree.openAPIDoc(
+                parameters=[openapi.queryParameter('color', description='The color of the thing')],
+                responses=openapi.applicationJSON({'schema': {'type': 'object'}}),
+                )(handler)
+        Sub.app.route('/thing{}/<thingID>'.format(r), methods=['GET', 'PUT'])(handler)
+        setattr(Sub, handler.__name__, handler)
+
+    Sub.__name__ = 'Sub{}'.format(n)
+    return Sub
+
+
+class Root(object):
+    app = Klein()
+
+
+for _n in range(SUBAPPS):
+    globals()['Sub{}'.format(_n)] = _subApp(_n)
+
+    def _enter(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+    _enter.__name__ = 'sub{}'.format(_n)
+    _enter = tree.enter('{}.Sub{}'.format(__name__, _n))(_enter)
+    Root.app.route('/sub{}/'.format(_n), branch=True)(_enter)
+    setattr(Root, _enter.__name__, _enter)
+
+
+def stdlibJSON(spec):
+    with patch.object(openapi, 'orjson', None):
+        return openapi.toJSON(spec)
+
+
+def parseDocstrings(handlers):
+    for handler in handlers:
+        urltool.OpenAPIExtendedDocumentation.fromObject(handler, decode=True)
+
+
+def parseDocstringsPurePython(handlers):
+    with patch.object(yamlhack, 'Loader', yamlhack.PyLoader):
+        parseDocstrings(handlers)
+
+
+def build():
+    bench = Bench()
+    spec = urltool.buildSpec(Root)
+    assert len(spec.paths) == SUBAPPS * ROUTES
+
+    handlers = [getattr(globals()['Sub{}'.format(n)], 'thing{}'.format(r)) for n in range(SUBAPPS) for r in range(ROUTES)]
+
+    # a DocCache that is never saved
+    docCache = DocCache(None)
+    urltool.buildSpec(Root, docCache=docCache)
+
+    bench.add('buildSpec', lambda: urltool.buildSpec(Root))
+    bench.add('buildSpec warm doc cache', lambda: urltool.buildSpec(Root, docCache=docCache))
+    bench.add('buildSpec 4 jobs', lambda: urltool.buildSpec(Root, jobs=4))
+    bench.add('buildSpec one sub-app', lambda: urltool.buildSpec(Root, '^/sub3/'))
+    bench.add('buildSpec one sub-app, unanchored', lambda: urltool.buildSpec(Root, '/sub3/'))
+    bench.add('parse docstrings', lambda: parseDocstrings(handlers))
+    bench.add('parse docstrings pure python', lambda: parseDocstringsPurePython(handlers))
+    bench.add('write yaml', lambda: yamlhack.dump(spec))
+    bench.add('write json', lambda: openapi.toJSON(spec))
+    bench.add('write json without orjson', lambda: stdlibJSON(spec))
+    return bench
+
+
+if __name__ == '__main__':
+    build().main()
@@ -0,0 +1,148 @@
+"""
+A small offline benchmark harness: ops/sec and p50/p99 latency, compared against a saved baseline
+
+    bench = Bench()
+    bench.add('validate_token, HS256', lambda: validate_token(tok, SECRET))
+    bench.main()
+
+Each benchmark is called in batches, sized so one batch takes about BATCH_SECONDS, and the time of
+each batch divided by its size is one latency sample. Very fast operations are therefore timed
+without the clock dominating, at the cost of smoothing out single slow calls within a batch.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+import fnmatch
+import json
+import time
+
+from builtins import object
+
+import click
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+BATCH_SECONDS = 0.0002
+
+DEFAULT_DURATION = 0.5
+
+# slower than the baseline by this much is reported as a regression
+DEFAULT_TOLERANCE = 0.10
+
+
+def percentile(ordered, fraction):
+    """
+    -> the value at fraction (0..1) of the way through ordered, a sorted list
+    """
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(fn, duration=DEFAULT_DURATION):
+    """
+    Call fn repeatedly for about duration seconds
+
+    -> dict of ops (per second), p50 and p99 (seconds per call)
+    """
+    # calibrate: grow the batch until it takes long enough to time
+    size = 1
+    while True:
+        start = clock()
+        for n in range(size):
+            fn()
+        elapsed = clock() - start
+        if elapsed >= BATCH_SECONDS:
+            break
+        size *= 2
+
+    samples = []
+    calls = 0
+    total = 0.0
+    while total < duration:
+        start = clock()
+        for n in range(size):
+            fn()
+        elapsed = clock() - start
+        samples.append(elapsed / size)
+        calls += size
+        total += elapsed
+
+    samples.sort()
+    return {'ops': calls / total, 'p50': percentile(samples, 0.5), 'p99': percentile(samples, 0.99)}
+
+
+def _us(seconds):
+    return '{:.2f}'.format(seconds * 1e6)
+
+
+class Bench(object):
+    """
+    A named collection of benchmarks, with a command line for running them
+    """
+    def __init__(self):
+        self.benchmarks = OrderedDict()
+
+    def add(self, name, fn):
+        """
+        Add a benchmark that calls fn
+        """
+        self.benchmarks[name] = fn
+
+    def run(self, pattern='*', duration=DEFAULT_DURATION, baseline=None, tolerance=DEFAULT_TOLERANCE, echo=print):
+        """
+        Measure every benchmark whose name matches pattern (a glob)
+
+        -> (results, regressed), where results is {name: measurement} and regressed is a list of
+        names that are slower than in baseline
+        """
+        baseline = baseline or {}
+        results = OrderedDict()
+        regressed = []
+        echo('{:<48} {:>12} {:>10} {:>10} {:>9}'.format('benchmark', 'ops/s', 'p50 us', 'p99 us', 'vs base'))
+        for name, fn in self.benchmarks.items():
+            if not fnmatch.fnmatch(name, pattern):
+                continue
+
+            result = results[name] = measure(fn, duration)
+            change = ''
+            if name in baseline:
+                ratio = result['ops'] / baseline[name]['ops']
+                change = '{:+.1%}'.format(ratio - 1)
+                if ratio < 1 - tolerance:
+                    change += ' !'
+                    regressed.append(name)
+
+            echo('{:<48} {:>12.0f} {:>10} {:>10} {:>9}'.format(
+                name, result['ops'], _us(result['p50']), _us(result['p99']), change))
+
+        return results, regressed
+
+    def main(self):
+        """
+        Run the benchmarks from the command line
+        """
+        @click.command()
+        @click.option('--filter', 'pattern', default='*', help='Only run benchmarks matching this glob')
+        @click.option('--duration', default=DEFAULT_DURATION, help='Seconds to spend on each benchmark')
+        @click.option('--baseline', type=click.Path(dir_okay=False), help='Compare with results saved in this file')
+        @click.option('--save', type=click.Path(dir_okay=False), help='Save the results to this file')
+        @click.option('--tolerance', default=DEFAULT_TOLERANCE, help='Fraction slower than the baseline that counts as a regression')
+        def benchmain(pattern, duration, baseline, save, tolerance):
+            """
+            Measure ops/sec and p50/p99 latency, optionally against a baseline
+            """
+            saved = None
+            if baseline:
+                with open(baseline) as f:
+                    saved = json.load(f)
+
+            results, regressed = self.run(pattern, duration, saved, tolerance, click.echo)
+
+            if save:
+                with open(save, 'w') as f:
+                    json.dump(results, f, indent=2, sort_keys=True)
+
+            if regressed:
+                raise click.ClickException('{} regressed: {}'.format(len(regressed), ', '.join(regressed)))
+
+        benchmain()
@@ -1,34 +1,50 @@
 """
 Crosscap, the Klein helper
+
+The names below are imported the first time they are used, so `import crosscap` stays cheap for
+programs that only need part of it, e.g. crosscap.tree.enter and crosscap.permitting. The yaml
+representers for OpenAPI objects are registered when crosscap.openapi is first imported.
 """
+from importlib import import_module
 import sys
 
-import yaml
 
-from crosscap import urltool, openapi
-from crosscap.tree import openAPIDoc, enter
-from crosscap._version import __version__
-from crosscap import yamlhack # for side effects
+# name: (module, attribute in the module, or None for the module itself)
+_LAZY = {
+    '__version__': ('crosscap._version', '__version__'),
+    'buildSpec': ('crosscap.urltool', 'buildSpec'),
+    'enter': ('crosscap.tree', 'enter'),
+    'flatten': ('crosscap.tree', 'flatten'),
+    'openAPIDoc': ('crosscap.tree', 'openAPIDoc'),
+    'openapi': ('crosscap.openapi', None),
+    'RouteCache': ('crosscap.tree', 'RouteCache'),
+    'ServedSpec': ('crosscap.servespec', 'ServedSpec'),
+    'urltool': ('crosscap.urltool', None),
+    'warmUp': ('crosscap.tree', 'warmUp'),
+}
+
 
+def __getattr__(name):
+    try:
+        moduleName, attribute = _LAZY[name]
+    except KeyError:
+        raise AttributeError("module 'crosscap' has no attribute {!r}".format(name))
 
-(yamlhack, urltool, openapi, openAPIDoc, enter, __version__) # for pyflakes
+    value = import_module(moduleName)
+    if attribute is not None:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
 
 
-yaml.add_representer(openapi.OpenAPIParameter, openapi.representCleanOpenAPIParameter)
-yaml.add_representer(openapi.OpenAPIResponse, openapi.representCleanOpenAPIObjects)
-yaml.add_representer(openapi.OpenAPIResponses, openapi.representCleanOpenAPIObjects)
-yaml.add_representer(openapi.OpenAPIMediaType, openapi.representCleanOpenAPIObjects)
-yaml.add_representer(openapi.OpenAPIPathItem, openapi.representCleanOpenAPIPathItem)
-yaml.add_representer(openapi.OpenAPIOperation, openapi.representCleanOpenAPIOperation)
-yaml.add_representer(openapi.OpenAPI, openapi.representCleanOpenAPIObjects)
-yaml.add_representer(openapi.OpenAPIInfo, openapi.representCleanOpenAPIObjects)
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
 
-if sys.version_info.major == 3: # pragma: nocover
-    yaml.add_representer(str, urltool.literal_unicode_representer)
-else: # pragma: nocover
-    yaml.add_representer(type(u''), urltool.literal_unicode_representer)
 
-yaml.add_representer(bytes, urltool.literal_unicode_representer)
+if sys.version_info < (3, 7): # pragma: nocover
+    # no module __getattr__, so import everything now
+    for _name in _LAZY:
+        __getattr__(_name)
 
 
-__all__ = '__version__ openapi urltool openAPIDoc enter'.split()
+__all__ = '__version__ openapi urltool openAPIDoc enter flatten RouteCache warmUp buildSpec ServedSpec'.split()
@@ -1,7 +1,14 @@
-import pkg_resources
+try:
+    from importlib.metadata import version
+except ImportError: # pragma: nocover
+    # python < 3.8
+    import pkg_resources
 
+    def version(name):
+        return pkg_resources.get_distribution(name).version
 
-__version__ = pkg_resources.get_distribution('crosscap').version
+
+__version__ = version('crosscap')
 
 
 __all__ = ['__version__']
@@ -8,8 +8,6 @@ from builtins import object
 
 import attr
 
-import ftfy
-
 
 @attr.s
 class Documentation(object):
@@ -50,6 +48,7 @@ class Documentation(object):
     def fromString(cls, s, decode=None):
         out = inspect.cleandoc(s)
         if decode and isinstance(out, bytes): # pragma: nocover (doesn't run in python 3)
+            import ftfy
             return cls(ftfy.fix_encoding(out.decode('utf-8')))
         else:
             return cls(out)
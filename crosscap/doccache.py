@@ -0,0 +1,164 @@
+"""
+A file of parsed docstrings, so repeated urltool runs don't parse docstrings that haven't changed
+
+    cache = DocCache.load('.urltool-cache')
+    spec = urltool.buildSpec(rootCls, docCache=cache)
+    cache.save()
+
+Entries are keyed by a hash of the docstring, and the whole file is thrown away when it was written
+by a different version of crosscap. The file is gzipped JSON, with the few types that yaml's safe
+loader produces and JSON lacks (dicts with non-string keys, sets, bytes, dates) written as tagged
+objects, so loading a file written by someone else can't run code.
+"""
+import base64
+import binascii
+import datetime
+import gzip
+import hashlib
+import json
+import os
+
+from builtins import object
+
+import attr
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _version():
+    from crosscap._version import __version__
+    return __version__
+
+
+def _encode(value):
+    """
+    -> value, something yaml's safe loader produces, in a form JSON can write
+
+    Every JSON object in the result is a tagged value: {tag: data}
+    """
+    if isinstance(value, dict):
+        return {'map': [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {'set': [_encode(v) for v in value]}
+    if isinstance(value, bytes):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    return value
+
+
+def _decode(value):
+    """
+    -> the value that _encode() was given
+    """
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    (tag, data), = value.items()
+    if tag == 'map':
+        return dict((_decode(k), _decode(v)) for k, v in data)
+    if tag == 'set':
+        return set(_decode(v) for v in data)
+    if tag == 'bytes':
+        return base64.b64decode(data)
+    if tag == 'datetime':
+        return datetime.datetime.fromisoformat(data)
+    if tag == 'date':
+        return datetime.date.fromisoformat(data)
+    raise ValueError("unknown tag %r" % tag)
+
+
+def _key(docstring, decode):
+    if not isinstance(docstring, bytes):
+        docstring = docstring.encode('utf-8', 'surrogatepass')
+    return (bool(decode), hashlib.sha256(docstring).digest()[:16])
+
+
+@attr.s
+class DocCache(object):
+    """
+    Parsed docstrings, as {key: (raw, full, yamlData)}, which can be saved to path
+    """
+    path = attr.ib()
+    version = attr.ib(default=attr.Factory(_version))
+    entries = attr.ib(default=attr.Factory(dict), repr=False)
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    _added = attr.ib(default=attr.Factory(dict), repr=False)
+
+    @classmethod
+    def load(cls, path):
+        """
+        -> DocCache with the entries saved in path, or with none if path is missing, damaged, or
+        from another version of crosscap
+        """
+        self = cls(path)
+        try:
+            with gzip.open(path, 'rb') as f:
+                saved = json.loads(f.read().decode('utf-8'))
+            if saved['version'] != self.version:
+                return self
+            entries = {}
+            for decode, digest, raw, full, yamlData in saved['entries']:
+                entries[(decode, binascii.unhexlify(digest))] = (
+                    _decode(raw), _decode(full), _decode(yamlData))
+        except Exception: # missing or damaged, so start over
+            return self
+
+        self.entries = entries
+        return self
+
+    def get(self, docstring, decode):
+        """
+        -> (raw, full, yamlData) parsed from docstring, or None if it hasn't been parsed before
+        """
+        entry = self.entries.get(_key(docstring, decode))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, docstring, decode, raw, full, yamlData):
+        """
+        Remember what was parsed from docstring
+        """
+        key = _key(docstring, decode)
+        self.entries[key] = self._added[key] = (raw, full, yamlData)
+
+    def takeAdded(self):
+        """
+        -> {key: entry} of the entries put since the last takeAdded()
+        """
+        added, self._added = self._added, {}
+        return added
+
+    def update(self, entries):
+        """
+        Add entries, e.g. from another process's takeAdded()
+        """
+        self.entries.update(entries)
+        self._added.update(entries)
+
+    def save(self):
+        """
+        Write the entries to path, if there are new ones
+        """
+        if not self._added:
+            return
+        temp = '{}.{}.tmp'.format(self.path, os.getpid())
+        saved = {
+            'version': self.version,
+            'entries': [[decode, binascii.hexlify(digest).decode('ascii'), _encode(raw), _encode(full), _encode(yamlData)]
+                for (decode, digest), (raw, full, yamlData) in self.entries.items()],
+        }
+        with gzip.open(temp, 'wb') as f:
+            f.write(json.dumps(saved).encode('utf-8'))
+        _replace(temp, self.path)
+        self._added = {}
@@ -29,3 +29,18 @@ class ICurrentUser(Interface):
         """
         Handle the successfully-authenticated user (for example, by setting it as a property on the request handler)
         """
+
+
+class IPermitsMetrics(Interface):
+    """
+    A place to send timings and outcomes of requests through permits()
+    """
+    def observe(label, phase, seconds):
+        """
+        Record the time spent in one phase ('authn', 'authz' or 'handler') of a request to the decorated function named label
+        """
+
+    def count(label, outcome):
+        """
+        Count one request to the decorated function named label, with outcome 'allowed', 'forbidden' or 'error'
+        """
@@ -1,14 +1,23 @@
 """
 OpenAPI schema
 
-Includes yaml representation helpers
+Includes yaml representation helpers, which are registered with crosscap's yaml Dumper when this
+module is imported
 """
 from collections import OrderedDict
+import json
 
 from builtins import object
 
 import attr
 
+from crosscap import yamlhack
+
+try:
+    import orjson
+except ImportError: # pragma: nocover
+    orjson = None
+
 
 @attr.s
 class OpenAPIMediaType(object):
@@ -121,76 +130,136 @@ class OpenAPI(object):
     paths = attr.ib(default=attr.Factory(OrderedDict))
 
 
-def _orderedCleanDict(attrsObj):
+def _isAttrs(value):
+    return hasattr(value.__class__, '__attrs_attrs__')
+
+
+def _isEmpty(value):
     """
-    -> dict with false-values removed
+    Is value, an attribute of an OpenAPI object, left out when the object is written?
 
-    Also evaluates attr-instances for false-ness by looking at the values of their properties
+    An attrs instance is empty when all of its attributes are false, where an attrs instance
+    counts as true if it has any attributes at all.
     """
-    def _filt(k, v):
-        if attr.has(v):
-            return not not any(attr.astuple(v))
-        return not not v
+    if _isAttrs(value):
+        for a in value.__class__.__attrs_attrs__:
+            v = getattr(value, a.name)
+            if (_isAttrs(v) and v.__class__.__attrs_attrs__) or (not _isAttrs(v) and v):
+                return False
+        return True
+    return not value
 
-    return attr.asdict(attrsObj,
-        dict_factory=OrderedDict,
-        recurse=False,
-        filter=_filt)
 
+@attr.s
+class _Plan(object):
+    """
+    How to write one OpenAPI class as a dict
 
-def representCleanOpenAPIOperation(dumper, data):
+    - fields: [(attribute name, key)], written in this order, when not empty
+    - expand: the name of an attribute, a dict, whose items are written as keys after fields
+    - sortExpanded: write the items of expand sorted by key
     """
-    Unpack nonstandard attributes while representing an OpenAPIOperation
+    fields = attr.ib()
+    expand = attr.ib(default=None)
+    sortExpanded = attr.ib(default=False)
+
+    @classmethod
+    def forClass(cls, openAPIClass, keys=None, expand=None, sortExpanded=False):
+        keys = keys or {}
+        fields = [(a.name, keys.get(a.name, a.name)) for a in attr.fields(openAPIClass) if a.name != expand]
+        return cls(fields, expand, sortExpanded)
+
+
+# how to write each OpenAPI class
+_plans = {
+    OpenAPIParameter: _Plan.forClass(OpenAPIParameter, keys={'in_': 'in'}),
+    OpenAPIResponse: _Plan.forClass(OpenAPIResponse),
+    OpenAPIResponses: _Plan.forClass(OpenAPIResponses),
+    OpenAPIMediaType: _Plan.forClass(OpenAPIMediaType),
+    OpenAPIPathItem: _Plan.forClass(OpenAPIPathItem, expand='_operations', sortExpanded=True),
+    OpenAPIOperation: _Plan.forClass(OpenAPIOperation, expand='_extended'),
+    OpenAPI: _Plan.forClass(OpenAPI),
+    OpenAPIInfo: _Plan.forClass(OpenAPIInfo),
+}
+
+
+def toDict(obj, memo=None):
     """
-    dct = _orderedCleanDict(data)
-    if '_extended' in dct:
-        for k, ext in list(data._extended.items()):
-            dct[k] = ext
-        del dct['_extended']
-
-    return dumper.yaml_representers[type(dct)](dumper, dct)
+    Convert OpenAPI objects, and the dicts and lists holding them, to plain OrderedDicts and lists
 
+    Empty attributes of OpenAPI objects are left out, and the operations of a path item, and the
+    extended attributes of an operation, are written as keys of their own. The result can be
+    written as yaml or JSON.
 
-def representCleanOpenAPIPathItem(dumper, data):
+    An object found twice is converted once, so yaml still writes an alias for the second one.
+    memo, {id: (obj, converted)}, can be shared by several calls.
     """
-    Unpack operation key/values before representing an OpenAPIPathItem
+    if memo is None:
+        memo = {}
+    key = id(obj)
+    if key in memo:
+        return memo[key][1]
+
+    plan = _plans.get(obj.__class__)
+    if plan is not None:
+        ret = memo[key] = (obj, OrderedDict())
+        out = ret[1]
+        for name, k in plan.fields:
+            value = getattr(obj, name)
+            if not _isEmpty(value):
+                out[k] = toDict(value, memo)
+        if plan.expand is not None:
+            items = getattr(obj, plan.expand).items()
+            for k, value in sorted(items) if plan.sortExpanded else items:
+                out[k] = toDict(value, memo)
+        return out
+
+    if isinstance(obj, dict):
+        out = OrderedDict()
+        memo[key] = (obj, out)
+        for k, value in obj.items():
+            out[k] = toDict(value, memo)
+        return out
+
+    if isinstance(obj, (list, tuple)):
+        if obj == ():
+            # yaml never writes an alias for (), so don't make it a shared list
+            return []
+        out = []
+        memo[key] = (obj, out)
+        for value in obj:
+            out.append(toDict(value, memo))
+        return out
+
+    return obj
+
+
+def representOpenAPIObject(dumper, data):
     """
-    dct = _orderedCleanDict(data)
-    if '_operations' in dct:
-        items = sorted(data._operations.items())
-        for k, op in items:
-            dct[k] = op
-        del dct['_operations']
-
+    Produce a representation of an OpenAPI object with toDict
+    """
+    memo = dumper.__dict__.setdefault('_openAPIMemo', {})
+    dct = toDict(data, memo)
     return dumper.yaml_representers[type(dct)](dumper, dct)
 
 
-def representCleanOpenAPIParameter(dumper, data):
-    """
-    Rename python reserved keyword fields before representing an OpenAPIParameter
-    """
-    dct = _orderedCleanDict(data)
-    # We are using "in_" as a key for the "in" parameter, since in is a Python keyword.
-    # To represent it correctly, we then have to swap "in_" for "in".
-    # So we do an item-by-item copy of the dct so we don't change the order when
-    # making this swap.
-    d2 = OrderedDict()
-    for k, v in dct.copy().items():
-        if k == 'in_':
-            d2['in'] = v
-        else:
-            d2[k] = v
+# these used to be different
+representCleanOpenAPIOperation = representOpenAPIObject
+representCleanOpenAPIPathItem = representOpenAPIObject
+representCleanOpenAPIParameter = representOpenAPIObject
+representCleanOpenAPIObjects = representOpenAPIObject
 
-    return dumper.yaml_representers[type(d2)](dumper, d2)
 
-
-def representCleanOpenAPIObjects(dumper, data):
-    """
-    Produce a representation of an OpenAPI object, removing empty attributes
+def toJSON(obj):
     """
-    dct = _orderedCleanDict(data)
+    -> obj, converted with toDict, as indented JSON encoded in utf-8
 
-    return dumper.yaml_representers[type(dct)](dumper, dct)
+    This uses orjson, when it is installed, which is much faster than the json module.
+    """
+    data = toDict(obj)
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
 
 
 def mediaTypeHelper(mediaType):
@@ -220,3 +289,7 @@ def queryParameter(name, **kwargs):
     Shorthand for a query parameter
     """
     return OpenAPIParameter(name=name, in_="query", **kwargs)
+
+
+for _cls in _plans:
+    yamlhack.add_representer(_cls, representOpenAPIObject)
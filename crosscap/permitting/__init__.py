@@ -3,19 +3,38 @@ Bolts of an auth framework for the web
 """
 
 from crosscap.interface import ICurrentUser
+from crosscap.permitting.cache import TokenCache
 from crosscap.permitting.core import (
     create_timed_token, 
+    create_timed_tokens,
     extract_bearer_token, 
     permits, 
-    role_in, 
     validate_token
 )
+from crosscap.permitting.keyring import KeyRing
+from crosscap.permitting.metrics import InMemoryMetrics
+from crosscap.permitting.offload import ThreadedVerifier
+from crosscap.permitting.revocation import RevocationIndex, TokenRevoked
+from crosscap.permitting.rules import all_of, any_of, costs, effective_roles, not_, role_in, RoleHierarchy
 
 __all__ = [
+    'all_of',
+    'any_of',
+    'costs',
     'create_timed_token', 
+    'create_timed_tokens',
+    'effective_roles',
     'extract_bearer_token', 
     'ICurrentUser', 
+    'InMemoryMetrics',
+    'KeyRing',
+    'not_',
     'permits', 
+    'RevocationIndex',
     'role_in', 
+    'RoleHierarchy',
+    'ThreadedVerifier',
+    'TokenCache',
+    'TokenRevoked',
     'validate_token',
     ]
@@ -0,0 +1,35 @@
+"""
+The coroutine half of crosscap.permitting.chain
+
+This uses async/await syntax, so it is only imported when an awaitable actually turns up.
+"""
+from inspect import isawaitable
+
+
+async def then_await(awaitable, fn, args):
+    """
+    Await the value, then call fn with it, awaiting the result of fn too if necessary
+    """
+    result = fn(await awaitable, *args)
+    if isawaitable(result):
+        result = await result
+    return result
+
+
+async def handled_await(awaitable, handled, failed, args):
+    """
+    Await the value, then call handled with it, or failed with the exception it raised
+    """
+    try:
+        result = await awaitable
+    except BaseException as e:
+        failed(e, *args)
+        raise
+    return handled(result, *args)
+
+
+async def resolve(awaitable):
+    """
+    Wrap any awaitable in a coroutine, so Twisted's ensureDeferred will accept it
+    """
+    return await awaitable
@@ -0,0 +1,155 @@
+"""
+A bounded cache of verified JWT payloads, for use with validate_token
+
+Signature verification is the expensive part of validating a token, and clients tend to present
+the same bearer token on many requests in a row. A TokenCache remembers the payload of each
+token it has verified until the token's `exp` claim passes, or until it falls off the end of
+the LRU. Tokens that failed verification are remembered for a short time as well, so a client
+hammering us with a bad token doesn't cost a signature check every time.
+
+    cache = TokenCache(maxsize=4096)
+    payload = validate_token(token, secret, cache=cache)
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from builtins import object
+
+import jwt
+
+
+DEFAULT_MAXSIZE = 1024
+DEFAULT_NEGATIVE_MAXSIZE = 128
+DEFAULT_NEGATIVE_TTL = 30 # seconds
+
+
+def _freeze(value):
+    """
+    Convert the keyword arguments of a decode call into something hashable
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _key_identity(key):
+    """
+    -> a hashable that stands for the verification key
+
+    Key objects (e.g. RSA public keys from a KeyRing) are not necessarily hashable, so they are
+    identified by id(). Every cache entry holds a reference to its key, so the id can't be reused
+    by another key while the entry exists.
+    """
+    if isinstance(key, (str, bytes)):
+        return key
+    return id(key)
+
+
+class TokenCache(object):
+    """
+    An LRU of verified token payloads, evicting each entry when its token expires
+
+    - maxsize: the number of verified payloads to remember
+    - negative_maxsize: the number of rejected tokens to remember
+    - negative_ttl: seconds to remember a rejected token
+    - clock: a callable returning the current unix time
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, negative_maxsize=DEFAULT_NEGATIVE_MAXSIZE,
+            negative_ttl=DEFAULT_NEGATIVE_TTL, clock=time.time):
+        self.maxsize = maxsize
+        self.negative_maxsize = negative_maxsize
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._entries = OrderedDict()
+        self._rejected = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        -> dict of counters, suitable for exposing on an admin endpoint
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'size': len(self._entries),
+            'negative_size': len(self._rejected),
+        }
+
+    def clear(self):
+        """
+        Forget every cached token, e.g. after the secret is rotated
+        """
+        with self._lock:
+            self._entries.clear()
+            self._rejected.clear()
+
+    def decode(self, token, secret, **kwargs):
+        """
+        Like `jwt.decode`, but answer from the cache when this token was already checked
+
+        Raises the same PyJWTError that verification raised, for a token that was rejected recently.
+        """
+        try:
+            key = (token, _key_identity(secret), _freeze(kwargs))
+            hash(key)
+        except TypeError:
+            # an option we don't know how to compare; don't guess
+            return jwt.decode(token, secret, **kwargs)
+
+        now = self.clock()
+        with self._lock:
+            payload = self._lookup(self._entries, key, now)
+            if payload is not None:
+                self.hits += 1
+                return payload.copy()
+
+            error = self._lookup(self._rejected, key, now)
+            if error is not None:
+                self.negative_hits += 1
+                raise type(error)(*error.args)
+
+            self.misses += 1
+
+        try:
+            payload = jwt.decode(token, secret, **kwargs)
+        except jwt.exceptions.PyJWTError as e:
+            self._store(self._rejected, self.negative_maxsize, key, e, now + self.negative_ttl, secret)
+            raise
+
+        self._store(self._entries, self.maxsize, key, payload, payload.get('exp'), secret)
+        return payload.copy()
+
+    def _lookup(self, entries, key, now):
+        """
+        Get an unexpired value and mark it recently used, or None
+        """
+        entry = entries.pop(key, None)
+        if entry is None:
+            return None
+        value, expires, _ = entry
+        if expires is not None and now >= expires:
+            return None
+        entries[key] = entry
+        return value
+
+    def _store(self, entries, maxsize, key, value, expires, secret):
+        """
+        Insert a value, evicting the least-recently used entry when full
+        """
+        if maxsize <= 0:
+            return
+        with self._lock:
+            entries.pop(key, None)
+            entries[key] = (value, expires, secret)
+            while len(entries) > maxsize:
+                entries.popitem(last=False)
@@ -0,0 +1,65 @@
+"""
+Continue a computation after a value that might not be ready yet
+
+permits() accepts ICurrentUser implementations and rules that return Deferreds (Twisted, Klein) or
+other awaitables (asyncio, Tornado). Plain values are passed straight through, so the synchronous
+path only pays for a type check at each step.
+"""
+import inspect
+import types
+
+from twisted.internet import defer
+
+
+_isawaitable = getattr(inspect, 'isawaitable', lambda value: False)
+
+_MAX_PLAIN_TYPES = 256
+
+# Types whose instances are never Deferreds or awaitables. This grows as we see results of
+# new types, since checking against the Awaitable ABC is comparatively slow.
+_plain_types = set([bool, type(None), int, str, bytes, dict, list, tuple])
+
+
+def is_async(value):
+    """
+    Is value a Deferred or an awaitable, rather than a result?
+    """
+    cls = type(value)
+    if cls in _plain_types:
+        return False
+
+    if isinstance(value, defer.Deferred) or _isawaitable(value):
+        return True
+
+    # generators are only sometimes awaitable, so they have to be checked every time
+    if len(_plain_types) < _MAX_PLAIN_TYPES and cls is not types.GeneratorType:
+        _plain_types.add(cls)
+    return False
+
+
+def then(value, fn, *args):
+    """
+    Call fn(value, *args) right away if value is a plain result, otherwise when it is ready
+
+    -> the result of fn; or a Deferred if value was a Deferred; or a coroutine if value was some
+    other awaitable
+    """
+    if type(value) in _plain_types or not is_async(value):
+        return fn(value, *args)
+
+    if isinstance(value, defer.Deferred):
+        return value.addCallback(_deferred_step, fn, args)
+
+    from crosscap.permitting._coroutine import then_await
+    return then_await(value, fn, args)
+
+
+def _deferred_step(result, fn, args):
+    """
+    Run one step of a Deferred chain, making sure a coroutine from that step is chained too
+    """
+    result = fn(result, *args)
+    if not isinstance(result, defer.Deferred) and _isawaitable(result):
+        from crosscap.permitting._coroutine import resolve
+        return defer.ensureDeferred(resolve(result))
+    return result
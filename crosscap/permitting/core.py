@@ -19,30 +19,89 @@ A framework for authorizing HTTP traffic in a Klein-based web service
     - implement .forbidden to cause something to happen when a client tries to make an unauthorized request
     - implement .roles to produce a sequence of the roles possessed by a user.
 """
+from calendar import timegm
 from datetime import datetime, timedelta
+from operator import attrgetter
 import re
 
 import jwt
 
 import wrapt
 
-from twisted.python.components import getAdapterFactory
+from twisted.internet import defer
+from twisted.python.components import getAdapterFactory, globalRegistry
+from twisted.web.iweb import IRequest
 
 from crosscap.interface import ICurrentUser
+from crosscap.permitting import metrics
+from crosscap.permitting.chain import is_async, then
+from crosscap.permitting.keyring import KeyRing
+from crosscap.permitting.revocation import TokenRevoked
+from crosscap.permitting.rules import all_of, request_cache, role_in
+
+
+(role_in,) # for pyflakes; role_in used to live here
 
 
 JWT_ALGO = ('HS256',)
 JWT_DURATION = 600 # 10 minutes
 
 
-def role_in(roles_allowed):
+_MAX_HANDLER_SHAPES = 64
+
+_get_class = attrgetter('__class__')
+
+
+class _HandlerCache(object):
     """
-    A permission checker that checks that a role possessed by the user matches one of the role_in list
+    Remember where a decorated function receives its request handler, and how to adapt it
+
+    We're looking for a request object, which will have an adapter to ICurrentUser.
+    This recognizes TWO distinct ways a request handler can be provided:
+    - it is the first argument to a function (klein/flask)
+    - it is the `self' argument to a method (similar to Tornado RequestHandler)
+
+    Searching the adapter registry on every call is slow, so the answer is remembered for each
+    combination of (instance, arg 0, arg 1) classes, until another adapter gets registered.
     """
-    def _check_with_authuser(authuser):
-        return any(r in authuser.roles for r in roles_allowed)
-    
-    return _check_with_authuser
+    def __init__(self):
+        self.generation = None
+        self.shapes = {}
+
+    def find(self, wrapped, instance, args):
+        """
+        -> (handler, adapter factory) for one call of the decorated function
+        """
+        if self.generation != globalRegistry._generation:
+            self.shapes = {}
+            self.generation = globalRegistry._generation
+
+        key = (instance.__class__,) + tuple(map(_get_class, args[:2]))
+        found = self.shapes.get(key)
+        if found is None:
+            if len(self.shapes) >= _MAX_HANDLER_SHAPES:
+                self.shapes = {}
+            found = self.shapes[key] = self._search(key)
+
+        slot, factory = found
+        if factory is None:
+            raise TypeError("{!r} should be a function that gets passed the request handler in the first 1 or 2 arguments".format(wrapped))
+
+        # slot 0 is likely the self argument to a bound instancemethod (tornado-style);
+        # slot 1 is either the first argument to a regular method or function (flask, klein with
+        # top-level functions), OR the self argument to an instancemethod called unbound
+        # (sometimes happens with decorators)
+        return (instance if slot == 0 else args[slot - 1]), factory
+
+    def _search(self, classes):
+        """
+        -> (slot, factory) for the first class in classes that adapts to ICurrentUser
+        """
+        for slot, cls in enumerate(classes):
+            factory = getAdapterFactory(cls, ICurrentUser, None)
+            if factory is not None:
+                return slot, factory
+        return None, None
 
 
 def permits(*rules):
@@ -51,60 +110,190 @@ def permits(*rules):
     1. the user is authenticated, and
     2. the specified security factors are satisfied.
 
-    - rules: a list of callables. each callable must take the authuser as an argument and return True or False
+    - rules: a list of callables. each callable must take the authuser as an argument and return True or False.
+      They are combined with all_of, so when they all have a cost (see crosscap.permitting.rules.costs),
+      cheaper rules are checked first; otherwise they are checked in the order given
     - forbidden: a callable which will be called with the handler object, and the result returned, for a 403/Forbidden message
     - authenticated: a callable which will be called with the handler and user object, after authentication is checked but before authorization
+
+    authenticate, authenticated and the rules may also return a Deferred or an awaitable. In that
+    case the decorated function returns a Deferred or a coroutine, which Klein and Tornado will
+    wait on, instead of blocking.
+
+    A request is authenticated only once, even when it passes through several permits() layers (e.g.
+    a protected branch created with crosscap.tree.enter, leading to protected routes). The
+    authenticated ICurrentUser is remembered on the request itself: the request handler when it
+    is a twisted.web request (Klein), otherwise a twisted.web request among the first two
+    arguments, otherwise the handler's .request (Tornado). When there is no such request, as when
+    the handler is some other object that may live across requests, nothing is remembered and
+    every layer authenticates.
     """
-    def _do_authentication(authuser):
-        u = authuser.authenticate()
-        if not u:
-            return None
-
-        # call the authenticated handler BEFORE checking authorization, so there is a user
-        # to check permissions rules against
-        return authuser.authenticated(u)
-
-    def _do_authorization(authuser, user):
-        return all(rule(authuser) for rule in rules)
-
-    def _find_handler(wrapped, instance, args, kwargs):
-        # We're looking for a request object, which will have an adapter to ICurrentUser.
-        # This recognizes TWO distinct ways a request handler can be provided:
-        # - it is the first argument to a function (klein/flask)
-        # - it is the `self' argument to a method (similar to Tornado RequestHandler)
-        is_handler = lambda o: getAdapterFactory(o.__class__, ICurrentUser, None) is not None
-
-        # this is likely the self argument to a bound instancemethod (tornado-style)
-        if is_handler(instance):
-            return instance
-
-        # this is either the first argument to a regular method or function (flask, klein with top-level functions),
-        # OR
-        # the self argument to an instancemethod called unbound (sometimes happens with decorators)
-        for arg in args[:2]:
-            if is_handler(arg):
-                return arg
-
-        raise TypeError("{!r} should be a function that gets passed the request handler in the first 1 or 2 arguments".format(wrapped))
-        
+    policy = all_of(*rules)
+    handlers = _HandlerCache()
+
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):
-        handler = _find_handler(wrapped, instance, args, kwargs)
-        authuser = ICurrentUser(handler)
+        handler, factory = handlers.find(wrapped, instance, args)
+        memo = request_cache(_request(handler, args))
+        authuser = memo.get(_AUTHENTICATED)
+
+        timing = None
+        if metrics.recorder is not None:
+            timing = metrics.Timing(metrics.recorder, _label(wrapped), 'authz' if authuser else 'authn')
+
+        call = _Call(wrapped, args, kwargs, policy, memo, timing)
+        if timing is None:
+            return _start(authuser, factory, handler, call)
+
+        # record the phase and an error outcome if any step raises or fails
+        try:
+            result = _start(authuser, factory, handler, call)
+        except BaseException as e:
+            _failed(e, timing)
+            raise
+        if isinstance(result, defer.Deferred):
+            return result.addErrback(_failed, timing)
+        if is_async(result):
+            from crosscap.permitting._coroutine import handled_await
+            return handled_await(result, _passed, _failed, (timing,))
+        return result
 
-        # is the user found? (authenticated?)
-        user = _do_authentication(authuser)
-        if not user:
-            return authuser.forbidden()
+    return wrapper
 
-        # user found, but are they authorized for this resource?
-        if not _do_authorization(authuser, user):
-            return authuser.forbidden()
 
-        # all checks pass, return the resource
-        return wrapped(*args, **kwargs)
+def _start(authuser, factory, handler, call):
+    """
+    Authenticate the request, unless an outer layer did, and continue with the rules
+    """
+    if authuser is not None:
+        # an outer layer authenticated this request already
+        return _check_rules(authuser, call)
 
-    return wrapper
+    # is the user found? (authenticated?)
+    authuser = factory(handler)
+    return then(authuser.authenticate(), _authenticated, authuser, call)
+
+
+_AUTHENTICATED = 'authenticated'
+
+
+def _request(handler, args):
+    """
+    -> the object for the current request, which the authenticated user is remembered on, or None
+    """
+    if IRequest.providedBy(handler):
+        return handler
+    for arg in args[:2]:
+        if IRequest.providedBy(arg):
+            return arg
+    return getattr(handler, 'request', None)
+
+
+class _Call(object):
+    """
+    The state of one request passing through permits()
+    """
+    __slots__ = ('wrapped', 'args', 'kwargs', 'policy', 'memo', 'timing')
+
+    def __init__(self, wrapped, args, kwargs, policy, memo, timing):
+        self.wrapped = wrapped
+        self.args = args
+        self.kwargs = kwargs
+        self.policy = policy
+        self.memo = memo
+        self.timing = timing
+
+
+def _label(wrapped):
+    """
+    -> the name of a decorated function, for labeling metrics
+    """
+    return '{}.{}'.format(wrapped.__module__, getattr(wrapped, '__qualname__', wrapped.__name__))
+
+
+def _authenticated(u, authuser, call):
+    """
+    Continue permits() with the result of authenticate()
+    """
+    if not u:
+        return _forbid(authuser, call)
+
+    # call the authenticated handler BEFORE checking authorization, so there is a user
+    # to check permissions rules against
+    return then(authuser.authenticated(u), _authorize, authuser, call)
+
+
+def _authorize(user, authuser, call):
+    """
+    Continue permits() with the result of authenticated()
+    """
+    if not user:
+        return _forbid(authuser, call)
+
+    call.memo[_AUTHENTICATED] = authuser
+    if call.timing is not None:
+        call.timing.next('authz')
+
+    # user found, but are they authorized for this resource?
+    return _check_rules(authuser, call)
+
+
+def _check_rules(authuser, call):
+    """
+    Check the rules, and if they pass return the resource
+    """
+    passed = call.policy(authuser)
+    if is_async(passed):
+        return then(passed, _allow, authuser, call)
+    return _allow(passed, authuser, call)
+
+
+def _allow(passed, authuser, call):
+    """
+    Call the decorated function if the rules passed
+    """
+    if not passed:
+        return _forbid(authuser, call)
+
+    timing = call.timing
+    if timing is None:
+        return call.wrapped(*call.args, **call.kwargs)
+
+    timing.next('handler')
+    result = call.wrapped(*call.args, **call.kwargs)
+    if is_async(result):
+        return then(result, _handled, timing)
+    return _handled(result, timing)
+
+
+def _handled(result, timing):
+    """
+    Record the time taken by the decorated function
+    """
+    timing.finish(metrics.ALLOWED)
+    return result
+
+
+def _failed(reason, timing):
+    """
+    Record the time taken by the step that raised an exception or failed, whether authenticating,
+    checking the rules or the decorated function, unless the request was recorded already
+    """
+    timing.fail()
+    return reason
+
+
+def _passed(result, timing):
+    return result
+
+
+def _forbid(authuser, call):
+    """
+    Refuse the request
+    """
+    if call.timing is not None:
+        call.timing.finish(metrics.FORBIDDEN)
+    return authuser.forbidden()
 
 
 def _assert_stringy(**kwargs):
@@ -123,16 +312,38 @@ def _assert_stringy(**kwargs):
 
 _NO_DEFAULT = object()
 
-def validate_token(token, secret, default=_NO_DEFAULT, **kwargs):
+def validate_token(token, secret, default=_NO_DEFAULT, cache=None, revoked=None, **kwargs):
     """
     Check a token signature and claims, and return the userid string (`sub` claim) or the supplied default
 
     If no default is passed in, this raises any exceptions that occur during token decode
+
+    Pass a `TokenCache` as cache= to skip verifying tokens that were verified recently
+
+    secret may also be a `KeyRing`, which picks the key and algorithm using the token's `kid` header.
+    The token must then be signed with that algorithm, whatever algorithms= says
+
+    Pass a `RevocationIndex` as revoked= to reject tokens that were revoked before their expiration
     """
-    _assert_stringy(secret=secret)
-    kwargs.setdefault('algorithms', [JWT_ALGO[0]])
+    is_keyring = isinstance(secret, KeyRing)
+    if not is_keyring:
+        _assert_stringy(secret=secret)
+        kwargs.setdefault('algorithms', [JWT_ALGO[0]])
+
     try:
-        payload = jwt.decode(token, secret, **kwargs)
+        key = secret
+        if is_keyring:
+            key, algorithm = secret.lookup(token)
+            kwargs['algorithms'] = [algorithm]
+
+        if cache is not None:
+            payload = cache.decode(token, key, **kwargs)
+        else:
+            payload = jwt.decode(token, key, **kwargs)
+
+        if revoked is not None and revoked.is_revoked(payload):
+            raise TokenRevoked("Token has been revoked")
+
         return payload
 
     except jwt.exceptions.PyJWTError:
@@ -169,16 +380,66 @@ def create_timed_token(sub, secret, duration=JWT_DURATION, **kwargs):
     t = jwt.encode(payload, secret, **kwargs)
 
     # Make sure we created a usable token.
-    # validate and create are slightly asymmetric in that you can allow multiple algorithms
-    # during decode, but only one during encode, so swap these around
-    validate_kwargs = kwargs.copy()
-    validate_kwargs.setdefault('algorithms', [validate_kwargs.pop('algorithm')])
-    validate_kwargs.setdefault('leeway', 1)
-    assert validate_token(t, secret, **validate_kwargs)
+    assert validate_token(t, secret, **_validate_kwargs(kwargs))
 
     return t
 
 
+def create_timed_tokens(subs, secret, duration=JWT_DURATION, verify=1, **kwargs):
+    """
+    Create tokens for many users at once, e.g. a fleet of service accounts
+
+    This is cheaper than calling create_timed_token in a loop: the key is prepared once, every token
+    shares one expiration time, and only the first `verify` tokens are checked with validate_token.
+    Since every token is signed the same way, checking one is enough to catch a bad key or
+    algorithm. Use verify=0 to skip the check entirely.
+
+    -> generator of tokens, in the same order as subs
+    """
+    _assert_stringy(secret=secret)
+    kwargs.setdefault('algorithm', JWT_ALGO[0])
+
+    exp = None
+    if duration is not None:
+        exp = timegm(_expiration(duration).utctimetuple())
+
+    algorithm = jwt.algorithms.get_default_algorithms().get(kwargs['algorithm'])
+    key = algorithm.prepare_key(secret) if algorithm else secret
+
+    return _issue_tokens(subs, secret, key, exp, verify, kwargs)
+
+
+def _issue_tokens(subs, secret, key, exp, verify, kwargs):
+    """
+    Generate the tokens for create_timed_tokens
+    """
+    validate_kwargs = _validate_kwargs(kwargs)
+    for n, sub in enumerate(subs):
+        _assert_stringy(sub=sub)
+        payload = {'sub': sub}
+        if exp is not None:
+            payload['exp'] = exp
+
+        t = jwt.encode(payload, key, **kwargs)
+        if n < verify:
+            assert validate_token(t, secret, **validate_kwargs)
+
+        yield t
+
+
+def _validate_kwargs(encode_kwargs):
+    """
+    -> kwargs for validate_token that check a token created with encode_kwargs
+
+    validate and create are slightly asymmetric in that you can allow multiple algorithms
+    during decode, but only one during encode, so swap these around
+    """
+    validate_kwargs = encode_kwargs.copy()
+    validate_kwargs.setdefault('algorithms', [validate_kwargs.pop('algorithm')])
+    validate_kwargs.setdefault('leeway', 1)
+    return validate_kwargs
+
+
 def _expiration(duration):
     """
     Generate a datetime now + duration seconds
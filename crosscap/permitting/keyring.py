@@ -0,0 +1,110 @@
+"""
+A ring of verification keys indexed by `kid`, for validate_token
+
+    ring = KeyRing.from_jwks_file('/etc/myapp/jwks.json')
+    payload = validate_token(token, ring)
+
+The token's `kid` header picks the key, so several keys can be active at once while keys are being
+rotated. Keys are parsed once, when they are added to the ring, instead of every time a token is
+checked; for RS256 and ES256 that saves re-reading PEM key material on every request.
+"""
+import json
+
+from builtins import object
+
+import jwt
+
+
+# what to assume for a JWK that doesn't say what its algorithm is
+_KTY_ALGORITHMS = {
+    'oct': 'HS256',
+    'RSA': 'RS256',
+    'OKP': 'EdDSA',
+}
+
+_EC_CURVE_ALGORITHMS = {
+    'P-256': 'ES256',
+    'P-384': 'ES384',
+    'P-521': 'ES512',
+}
+
+
+def _algorithm(name):
+    """
+    -> the jwt Algorithm object for name
+    """
+    algorithm = jwt.algorithms.get_default_algorithms().get(name)
+    if algorithm is None:
+        raise NotImplementedError("Algorithm {!r} not supported".format(name))
+    return algorithm
+
+
+class KeyRing(object):
+    """
+    Pre-parsed verification keys, looked up by the `kid` header of each token
+
+    - default_kid: the key to use for tokens that have no `kid` header
+    """
+    def __init__(self, default_kid=None):
+        self.default_kid = default_kid
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def add(self, kid, key, algorithm):
+        """
+        Parse key (a secret, a PEM string or a key object) and make it available for tokens signed with kid
+        """
+        self._keys[kid] = (_algorithm(algorithm).prepare_key(key), algorithm)
+
+    def remove(self, kid):
+        """
+        Stop accepting tokens signed with kid
+        """
+        del self._keys[kid]
+
+    def lookup(self, token):
+        """
+        -> (key, algorithm) for verifying token
+
+        Raises a jwt InvalidKeyError if the token names a key that isn't on the ring
+        """
+        kid = jwt.get_unverified_header(token).get('kid', self.default_kid)
+        found = self._keys.get(kid)
+        if found is None:
+            raise jwt.exceptions.InvalidKeyError("No key {!r} in the key ring".format(kid))
+        return found
+
+    @classmethod
+    def from_jwks(cls, jwks, default_kid=None):
+        """
+        Build a KeyRing from a JWKS document, i.e. a dict with a 'keys' list of JWKs
+
+        Every JWK must have a 'kid'. A JWK without an 'alg' gets the usual algorithm for its key type
+        and curve, and raises a jwt InvalidKeyError if there isn't one.
+        """
+        self = cls(default_kid)
+        for jwk in jwks['keys']:
+            algorithm = jwk.get('alg')
+            if algorithm is None:
+                if jwk.get('kty') == 'EC':
+                    algorithm = _EC_CURVE_ALGORITHMS.get(jwk.get('crv'))
+                else:
+                    algorithm = _KTY_ALGORITHMS.get(jwk.get('kty'))
+                if algorithm is None:
+                    raise jwt.exceptions.InvalidKeyError("JWK {!r} has no 'alg', and kty {!r} (crv {!r}) has no usual algorithm".format(
+                        jwk.get('kid'), jwk.get('kty'), jwk.get('crv')))
+            self.add(jwk['kid'], _algorithm(algorithm).from_jwk(json.dumps(jwk)), algorithm)
+        return self
+
+    @classmethod
+    def from_jwks_file(cls, path, default_kid=None):
+        """
+        Build a KeyRing from a local JWKS file
+        """
+        with open(path) as f:
+            return cls.from_jwks(json.load(f), default_kid)
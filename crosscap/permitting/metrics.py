@@ -0,0 +1,189 @@
+"""
+Timing and outcome metrics for permits()
+
+permits() records nothing until a metrics recorder is installed, and checks for one with a single
+attribute lookup per request, so there is no cost when metrics are off.
+
+    from crosscap.permitting import metrics
+
+    recorder = metrics.InMemoryMetrics()
+    metrics.install(recorder)
+
+    @app.route('/admin/metrics')
+    @permits(role_in([ROLE_ADMIN]))
+    def showMetrics(request):
+        request.setHeader('content-type', 'text/plain')
+        return recorder.dump_text()
+
+Each decorated function is labeled by its module and name. For each label we record the time spent
+in each phase of a request:
+
+- authn: authenticate() and authenticated()
+- authz: the rules
+- handler: the decorated function itself, until its Deferred or awaitable (if any) is done
+
+and a count of requests with each outcome: allowed, forbidden, or error when authenticating,
+checking the rules or the decorated function raised an exception, or its Deferred or awaitable
+failed. An error is counted in the phase it happened in.
+"""
+import json
+import threading
+import time
+
+from builtins import object
+
+from zope.interface import implementer
+
+from crosscap.interface import IPermitsMetrics
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+ALLOWED = 'allowed'
+FORBIDDEN = 'forbidden'
+ERROR = 'error'
+
+
+# the installed IPermitsMetrics, or None
+recorder = None
+
+
+def install(metrics):
+    """
+    Start sending permits() metrics to an IPermitsMetrics provider; install(None) stops
+    """
+    global recorder
+    recorder = metrics
+
+
+class Timing(object):
+    """
+    Time the phases of one request through permits()
+    """
+    __slots__ = ('recorder', 'label', 'phase', 'started', 'finished')
+
+    def __init__(self, recorder, label, phase):
+        self.recorder = recorder
+        self.label = label
+        self.phase = phase
+        self.started = clock()
+        self.finished = False
+
+    def next(self, phase):
+        """
+        Record the time spent in the current phase, and start the next one
+        """
+        now = clock()
+        self.recorder.observe(self.label, self.phase, now - self.started)
+        self.phase = phase
+        self.started = now
+
+    def finish(self, outcome=None):
+        """
+        Record the time spent in the current phase, and the outcome of the request if there is one
+        """
+        self.finished = True
+        self.recorder.observe(self.label, self.phase, clock() - self.started)
+        if outcome is not None:
+            self.recorder.count(self.label, outcome)
+
+    def fail(self):
+        """
+        Finish with an error outcome, unless finish() was called already
+        """
+        if not self.finished:
+            self.finish(ERROR)
+
+
+def _bucket_label(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+class _Histogram(object):
+    """
+    Counts of observations in each of the BUCKETS, plus their sum
+    """
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for n, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[n] += 1
+                break
+        self.total += 1
+        self.sum += seconds
+
+    def as_dict(self):
+        """
+        -> dict with the count, sum and cumulative bucket counts
+        """
+        cumulative = 0
+        buckets = {}
+        for bound, n in zip(BUCKETS, self.counts):
+            cumulative += n
+            buckets[_bucket_label(bound)] = cumulative
+        return {'count': self.total, 'sum': self.sum, 'buckets': buckets}
+
+
+@implementer(IPermitsMetrics)
+class InMemoryMetrics(object):
+    """
+    In-process counters and latency histograms, which can be dumped as text or JSON
+    """
+    def __init__(self):
+        self._outcomes = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, phase, seconds):
+        with self._lock:
+            histogram = self._latencies.get((label, phase))
+            if histogram is None:
+                histogram = self._latencies[(label, phase)] = _Histogram()
+            histogram.observe(seconds)
+
+    def count(self, label, outcome):
+        with self._lock:
+            key = (label, outcome)
+            self._outcomes[key] = self._outcomes.get(key, 0) + 1
+
+    def as_dict(self):
+        """
+        -> {label: {'outcomes': {outcome: count}, 'latency': {phase: histogram}}}
+        """
+        with self._lock:
+            ret = {}
+            for (label, outcome), n in self._outcomes.items():
+                ret.setdefault(label, {'outcomes': {}, 'latency': {}})['outcomes'][outcome] = n
+            for (label, phase), histogram in self._latencies.items():
+                ret.setdefault(label, {'outcomes': {}, 'latency': {}})['latency'][phase] = histogram.as_dict()
+            return ret
+
+    def dump_json(self):
+        """
+        -> the metrics as a JSON string
+        """
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def dump_text(self):
+        """
+        -> the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for label, data in sorted(self.as_dict().items()):
+            for outcome, n in sorted(data['outcomes'].items()):
+                lines.append('permits_requests_total{function="%s",outcome="%s"} %d' % (label, outcome, n))
+            for phase, histogram in sorted(data['latency'].items()):
+                tags = 'function="%s",phase="%s"' % (label, phase)
+                for bound in BUCKETS:
+                    le = _bucket_label(bound)
+                    lines.append('permits_seconds_bucket{%s,le="%s"} %d' % (tags, le, histogram['buckets'][le]))
+                lines.append('permits_seconds_sum{%s} %r' % (tags, histogram['sum']))
+                lines.append('permits_seconds_count{%s} %d' % (tags, histogram['count']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,123 @@
+"""
+Verify tokens on a bounded pool of worker threads, instead of the reactor or IOLoop thread
+
+RSA and ECDSA signature checks cost milliseconds of CPU, and every other connection waits while
+they run on the event loop thread. A ThreadedVerifier moves them to worker threads; cheap HMAC
+checks still run inline, since a thread hop would cost more than the check itself.
+
+    verifier = ThreadedVerifier(size=4)
+
+    @implementer(ICurrentUser)
+    class AuthUser(object):
+        def authenticate(self):
+            d = verifier.validate_token_deferred(self.token, keyring, default=None)
+            return d.addCallback(lambda payload: payload and USER_DATABASE.get(payload['sub']))
+
+permits() waits for the Deferred without blocking. Under Tornado or asyncio, use
+validate_token_future instead, which returns an asyncio Future.
+"""
+import functools
+
+from builtins import object
+
+import jwt
+
+from twisted.internet import defer, threads
+
+from crosscap.permitting.core import _NO_DEFAULT, validate_token
+from crosscap.permitting.keyring import KeyRing
+
+
+DEFAULT_POOL_SIZE = 4
+
+INLINE_ALGORITHMS = frozenset(['HS256', 'HS384', 'HS512'])
+
+
+class ThreadedVerifier(object):
+    """
+    Run validate_token on worker threads, for expensive signature algorithms
+
+    - size: the most threads to verify tokens with at once
+    - inline_algorithms: verify tokens using these algorithms on the calling thread
+    - reactor: the Twisted reactor to use with validate_token_deferred
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, inline_algorithms=INLINE_ALGORITHMS, reactor=None):
+        self.size = size
+        self.inline_algorithms = inline_algorithms
+        self._reactor = reactor
+        self._threadpool = None
+        self._executor = None
+
+    def is_inline(self, token, secret):
+        """
+        Is token cheap enough to verify on the calling thread?
+        """
+        try:
+            if isinstance(secret, KeyRing):
+                algorithm = secret.lookup(token)[1]
+            else:
+                algorithm = jwt.get_unverified_header(token).get('alg')
+        except jwt.exceptions.PyJWTError:
+            # it will be rejected without checking a signature
+            return True
+        return algorithm in self.inline_algorithms
+
+    def validate_token_deferred(self, token, secret, default=_NO_DEFAULT, **kwargs):
+        """
+        Like validate_token, but -> a Deferred that fires with its result
+        """
+        if self.is_inline(token, secret):
+            return defer.maybeDeferred(validate_token, token, secret, default, **kwargs)
+
+        if self._threadpool is None:
+            self._start_threadpool()
+        return threads.deferToThreadPool(self._reactor, self._threadpool,
+                validate_token, token, secret, default, **kwargs)
+
+    def validate_token_future(self, token, secret, default=_NO_DEFAULT, **kwargs):
+        """
+        Like validate_token, but -> an asyncio Future of its result, or of any exception it raises
+
+        Call this from a coroutine or callback running on the event loop.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        call = functools.partial(validate_token, token, secret, default, **kwargs)
+        if self.is_inline(token, secret):
+            future = loop.create_future()
+            try:
+                future.set_result(call())
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.size)
+        return loop.run_in_executor(self._executor, call)
+
+    def stop(self):
+        """
+        Shut down the worker threads
+        """
+        if self._threadpool is not None:
+            self._threadpool.stop()
+            self._threadpool = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _start_threadpool(self):
+        """
+        Start a Twisted thread pool, which stops when the reactor does
+        """
+        from twisted.python.threadpool import ThreadPool
+
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+
+        self._threadpool = ThreadPool(minthreads=0, maxthreads=self.size, name='crosscap-verify')
+        self._threadpool.start()
+        self._reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
@@ -0,0 +1,102 @@
+"""
+Revoke tokens before their `exp`, e.g. on logout or when an account is compromised
+
+    revoked = RevocationIndex()
+    revoked.revoke(validate_token(token, secret))
+    ...
+    validate_token(token, secret, revoked=revoked) # raises TokenRevoked
+
+A token is identified by its `jti` claim, or by its `sub` and `iat` claims if it has no `jti`.
+Entries are dropped once the token's `exp` has passed, since an expired token is rejected anyway.
+"""
+import heapq
+from itertools import count
+import threading
+import time
+
+from builtins import object
+
+import jwt
+
+
+class TokenRevoked(jwt.exceptions.InvalidTokenError):
+    """
+    The token has a valid signature, but was revoked
+    """
+
+
+class RevocationIndex(object):
+    """
+    An in-memory index of revoked tokens
+
+    Checking a token is one or two dict lookups, and allocates nothing.
+
+    - clock: a callable returning the current unix time
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._jtis = {} # jti -> exp
+        self._issued = {} # sub -> {iat: exp}
+        self._expiring = [] # heap of (exp, n, jti, sub, iat)
+        self._counter = count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._jtis) + sum(len(iats) for iats in self._issued.values())
+
+    def revoke(self, payload):
+        """
+        Revoke the token with these claims
+
+        The payload must have a `jti` claim, or both `sub` and `iat` claims.
+        """
+        jti, sub, iat, exp = payload.get('jti'), payload.get('sub'), payload.get('iat'), payload.get('exp')
+        if jti is None and (sub is None or iat is None):
+            raise ValueError("Can't identify a token without jti, or sub and iat: {!r}".format(payload))
+
+        with self._lock:
+            if jti is not None:
+                self._jtis[jti] = exp
+            else:
+                self._issued.setdefault(sub, {})[iat] = exp
+
+            if exp is not None:
+                heapq.heappush(self._expiring, (exp, next(self._counter), jti, sub, iat))
+
+        self.prune()
+
+    def is_revoked(self, payload):
+        """
+        Has the token with these claims been revoked?
+        """
+        if self._jtis:
+            jti = payload.get('jti')
+            if jti is not None and jti in self._jtis:
+                return True
+
+        if self._issued:
+            iats = self._issued.get(payload.get('sub'))
+            if iats is not None and payload.get('iat') in iats:
+                return True
+
+        return False
+
+    def prune(self):
+        """
+        Forget revoked tokens that have expired
+        """
+        now = self.clock()
+        with self._lock:
+            expiring = self._expiring
+            while expiring and expiring[0][0] <= now:
+                exp, _, jti, sub, iat = heapq.heappop(expiring)
+                # only forget it if it wasn't revoked again with a later exp
+                if jti is not None:
+                    if self._jtis.get(jti) == exp:
+                        del self._jtis[jti]
+                else:
+                    iats = self._issued.get(sub, {})
+                    if iats.get(iat) == exp:
+                        del iats[iat]
+                        if not iats:
+                            del self._issued[sub]
@@ -0,0 +1,268 @@
+"""
+Authorization rules for use with permits()
+
+A rule is any callable that takes the ICurrentUser and returns True or False (or a Deferred or
+awaitable of True or False). Rules can be combined with all_of, any_of and not_:
+
+    @costs(100, pure=True)
+    def owns_document(authuser):
+        return DOCUMENTS.ownerOf(authuser.req.args['docID']) == authuser.userID
+
+    @permits(any_of(role_in([ADMIN]), all_of(role_in([EDITOR]), owns_document)))
+    def editDocument(self, request):
+        ...
+
+When every one of its rules has a cost (given with costs(); role_in and the combinators of such
+rules have one too), a combinator orders them by cost once, when it is built, so cheap rules are
+checked first and expensive ones are skipped when the answer is already known. Rules run in the
+order they were given when they cost the same, and when any of them has no cost, so a rule placed
+before another as a guard still runs first.
+"""
+import functools
+
+from builtins import object
+
+from crosscap.permitting.chain import is_async, then
+
+
+_CACHE_ATTRIBUTE = '_crosscap_cache'
+
+# the relative cost of a rule that hasn't said what it costs
+DEFAULT_COST = 10
+
+# the relative cost of a rule that only looks at the user's roles
+ROLE_COST = 1
+
+
+def request_cache(obj):
+    """
+    -> a dict for memoizing things about obj, which lives exactly as long as obj does
+
+    permits() builds a fresh ICurrentUser for every request, so anything stored in the request_cache
+    of the ICurrentUser is computed at most once per request.
+    """
+    try:
+        attributes = obj.__dict__
+    except AttributeError:
+        # no place to put it, so nothing is remembered
+        return {}
+
+    cache = attributes.get(_CACHE_ATTRIBUTE)
+    if cache is None:
+        cache = attributes[_CACHE_ATTRIBUTE] = {}
+    return cache
+
+
+def costs(cost, pure=False):
+    """
+    Decorate a rule with its relative cost, and whether it is pure
+
+    Combinators only reorder rules that all have a cost. A pure rule gives the same answer for the
+    same user throughout a request, so it is checked at most once per request, no matter how many
+    times it appears in the rules guarding the request.
+
+    -> a new rule that calls rule, so rule itself (e.g. a bound method) is not changed
+    """
+    def _decorate(rule):
+        @functools.wraps(rule)
+        def _costed(authuser):
+            return rule(authuser)
+
+        return _with_cost(_costed, cost, pure)
+
+    return _decorate
+
+
+def _with_cost(rule, cost, pure):
+    rule.crosscap_cost = cost
+    rule.crosscap_pure = pure
+    return rule
+
+
+def cost_of(rule):
+    """
+    -> the relative cost of checking rule
+    """
+    return getattr(rule, 'crosscap_cost', DEFAULT_COST)
+
+
+def _has_cost(rule):
+    return hasattr(rule, 'crosscap_cost')
+
+
+def _compile(rules):
+    """
+    -> tuple of (rule, pure) for rules, cheapest first if they all have a cost, otherwise in order
+    """
+    if all(_has_cost(rule) for rule in rules):
+        rules = sorted(rules, key=cost_of)
+    return tuple((rule, getattr(rule, 'crosscap_pure', False)) for rule in rules)
+
+
+def _check(rule, pure, authuser, cache):
+    """
+    -> the result of rule(authuser), memoized in the request_cache of authuser if the rule is pure
+    """
+    if not pure:
+        return rule(authuser)
+
+    if rule in cache:
+        return cache[rule]
+
+    passed = rule(authuser)
+    if is_async(passed):
+        return then(passed, _remember, cache, rule)
+    cache[rule] = passed
+    return passed
+
+
+def _remember(passed, cache, rule):
+    cache[rule] = passed
+    return passed
+
+
+def _run(steps, authuser, start, decisive):
+    """
+    Check steps[start:] in order, until one of them returns decisive
+
+    -> decisive if one of them did, otherwise (not decisive)
+    """
+    cache = request_cache(authuser)
+    for n in range(start, len(steps)):
+        rule, pure = steps[n]
+        passed = _check(rule, pure, authuser, cache)
+        if is_async(passed):
+            return then(passed, _resume, steps, authuser, n + 1, decisive)
+        if bool(passed) is decisive:
+            return decisive
+    return not decisive
+
+
+def _resume(passed, steps, authuser, start, decisive):
+    """
+    Continue _run with a rule's result, once it is known
+    """
+    if bool(passed) is decisive:
+        return decisive
+    return _run(steps, authuser, start, decisive)
+
+
+def _combined(steps):
+    """
+    -> the decorator for a rule built from steps, which has a cost if all of them do
+    """
+    pure = all(pure for rule, pure in steps)
+
+    def _decorate(rule):
+        if all(_has_cost(step) for step, _ in steps):
+            return _with_cost(rule, sum(cost_of(step) for step, _ in steps), pure)
+        rule.crosscap_pure = pure
+        return rule
+
+    return _decorate
+
+
+def all_of(*rules):
+    """
+    A rule that passes when every one of rules passes
+    """
+    steps = _compile(rules)
+
+    @_combined(steps)
+    def _check_all(authuser):
+        return _run(steps, authuser, 0, False)
+
+    return _check_all
+
+
+def any_of(*rules):
+    """
+    A rule that passes when at least one of rules passes
+    """
+    steps = _compile(rules)
+
+    @_combined(steps)
+    def _check_any(authuser):
+        return _run(steps, authuser, 0, True)
+
+    return _check_any
+
+
+def not_(rule):
+    """
+    A rule that passes when rule fails
+    """
+    steps = _compile([rule])
+    pure = steps[0][1]
+
+    @_combined(steps)
+    def _check_not(authuser):
+        return then(_check(rule, pure, authuser, request_cache(authuser)), _negate)
+
+    return _check_not
+
+
+def _negate(passed):
+    return not passed
+
+
+class RoleHierarchy(object):
+    """
+    Roles that imply other roles
+
+        hierarchy = RoleHierarchy({'admin': ['editor'], 'editor': ['viewer']})
+
+    A user with the admin role then also has editor and viewer. The transitive closure is worked out
+    once, when the hierarchy is built, so expanding a user's roles is a few set unions.
+    """
+    def __init__(self, implies):
+        self.closure = {}
+        for role in implies:
+            seen = set([role])
+            pending = [role]
+            while pending:
+                for implied in implies.get(pending.pop(), ()):
+                    if implied not in seen:
+                        seen.add(implied)
+                        pending.append(implied)
+            self.closure[role] = frozenset(seen)
+
+    def expand(self, roles):
+        """
+        -> frozenset of roles, plus all the roles they imply
+        """
+        expanded = set(roles)
+        for role in roles:
+            expanded.update(self.closure.get(role, ()))
+        return frozenset(expanded)
+
+
+def effective_roles(authuser, hierarchy=None):
+    """
+    -> frozenset of the roles possessed by authuser, including roles implied by the hierarchy
+
+    authuser.roles is read once per request and shared by all the rules that need it.
+    """
+    cache = request_cache(authuser)
+    key = ('roles', hierarchy)
+    roles = cache.get(key)
+    if roles is None:
+        own = cache.get(('roles', None))
+        if own is None:
+            own = cache[('roles', None)] = frozenset(authuser.roles)
+        roles = cache[key] = hierarchy.expand(own) if hierarchy is not None else own
+    return roles
+
+
+def role_in(roles_allowed, hierarchy=None):
+    """
+    A permission checker that checks that a role possessed by the user matches one of the role_in list
+
+    - hierarchy: an optional RoleHierarchy, so users also have the roles implied by their own roles
+    """
+    allowed = frozenset(roles_allowed)
+
+    def _check_with_authuser(authuser):
+        return not allowed.isdisjoint(effective_roles(authuser, hierarchy))
+
+    return _with_cost(_check_with_authuser, ROLE_COST, True)
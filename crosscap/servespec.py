@@ -0,0 +1,212 @@
+"""
+Serve the OpenAPI spec of a running service, as JSON and yaml
+
+    class API(object):
+        app = Klein()
+        spec = ServedSpec('myservice.API')
+
+        openAPISpec = spec.route(app, '/openapi')
+
+serves /openapi.json and /openapi.yaml. The spec is built the first time it is requested, in a
+thread so the reactor is not blocked, and then served from memory: already encoded, already
+gzipped for clients that accept gzip, with a strong ETag so clients can revalidate with
+If-None-Match and get a 304. Call invalidate() to rebuild it, e.g. after reloading routes; the
+old spec is served until the new one is ready.
+"""
+from io import BytesIO
+import gzip
+import hashlib
+
+from builtins import object
+
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.reflect import namedAny
+
+import attr
+
+from crosscap import openapi, yamlhack
+
+
+CONTENT_TYPES = {
+    'json': b'application/json',
+    'yaml': b'application/yaml',
+}
+
+
+def _gzip(data):
+    """
+    -> data compressed with gzip, with no timestamp, so the same data always compresses the same
+    """
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _acceptsGzip(acceptEncoding):
+    """
+    Does an Accept-Encoding header value allow gzip?
+    """
+    for coding in (acceptEncoding or b'').split(b','):
+        params = coding.split(b';')
+        if params[0].strip().lower() not in (b'gzip', b'*'):
+            continue
+        for param in params[1:]:
+            k, _, v = param.partition(b'=')
+            if k.strip() == b'q':
+                try:
+                    return float(v) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _etagMatches(ifNoneMatch, etag):
+    """
+    Does an If-None-Match header value match etag? (using the weak comparison, as RFC 7232 asks)
+    """
+    for tag in ifNoneMatch.split(b','):
+        tag = tag.strip()
+        if tag == b'*' or tag.replace(b'W/', b'', 1) == etag:
+            return True
+    return False
+
+
+@attr.s
+class Encoded(object):
+    """
+    One encoding of the spec, ready to send
+    """
+    contentType = attr.ib()
+    data = attr.ib()
+    gzipped = attr.ib()
+    etag = attr.ib()
+    gzipETag = attr.ib()
+
+    @classmethod
+    def fromBytes(cls, contentType, data):
+        digest = hashlib.sha256(data).hexdigest()[:32].encode('ascii')
+        return cls(contentType, data, _gzip(data), b'"' + digest + b'"', b'"' + digest + b'-gzip"')
+
+
+@attr.s
+class ServedSpec(object):
+    """
+    The OpenAPI spec of rootCls (a class, or its FQPN), built once and served from memory
+    """
+    rootCls = attr.ib()
+    filt = attr.ib(default=None)
+    reverse = attr.ib(default=False)
+    _encoded = attr.ib(default=None, init=False, repr=False)
+    _building = attr.ib(default=None, init=False, repr=False)
+    _stale = attr.ib(default=False, init=False, repr=False)
+
+    def route(self, app, path='/openapi'):
+        """
+        Serve the spec at path.json and path.yaml of app
+
+        -> the route's handler. If app belongs to a class, assign this to an attribute of the class
+        named openAPISpec, as urltool looks up each route's handler by name.
+        """
+        @app.route(path + '.<any(json, yaml):ext>', methods=['GET', 'HEAD'])
+        def openAPISpec(*args, **kwargs):
+            """
+            The OpenAPI spec of this service
+            """
+            # args are (request,), or (instance, request) when app belongs to a class
+            return self.render(args[-1], kwargs['ext'])
+
+        return openAPISpec
+
+    def build(self):
+        """
+        Build and encode the spec
+
+        This is slow, and imports the modules of the whole tree, so call it in a thread.
+
+        -> {ext: Encoded}
+        """
+        from crosscap import urltool
+
+        rootCls = self.rootCls
+        if not isinstance(rootCls, type):
+            rootCls = namedAny(rootCls)
+
+        spec = urltool.buildSpec(rootCls, self.filt, self.reverse)
+        return {
+            'yaml': Encoded.fromBytes(CONTENT_TYPES['yaml'], yamlhack.dump(spec).encode('utf-8')),
+            'json': Encoded.fromBytes(CONTENT_TYPES['json'], openapi.toJSON(spec)),
+        }
+
+    def invalidate(self):
+        """
+        Rebuild the spec in a thread, serving the current one until that's done
+
+        -> Deferred that fires when the new spec is being served
+        """
+        if self._building is not None:
+            # a build that started before now may have missed the change
+            self._stale = True
+        return self._build()
+
+    def _build(self):
+        """
+        Start a build in a thread, unless one is running
+
+        -> Deferred that fires with {ext: Encoded} when the build is done
+        """
+        if self._building is None:
+            self._building = []
+            threads.deferToThread(self.build).addBoth(self._built)
+
+        d = defer.Deferred()
+        self._building.append(d)
+        return d
+
+    def _built(self, result):
+        waiting, self._building = self._building, None
+        if self._stale:
+            self._stale = False
+            for d in waiting:
+                self._build().chainDeferred(d)
+            return
+
+        if isinstance(result, Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+
+        self._encoded = result
+        for d in waiting:
+            d.callback(result)
+
+    def render(self, request, ext):
+        """
+        Respond to request with the spec encoded as ext, 'json' or 'yaml'
+
+        -> bytes, or a Deferred if the spec is not built yet
+        """
+        if self._encoded is None:
+            return self._build().addCallback(lambda encoded: self._respond(request, encoded[ext]))
+        return self._respond(request, self._encoded[ext])
+
+    def _respond(self, request, encoded):
+        useGzip = _acceptsGzip(request.getHeader(b'accept-encoding'))
+        etag = encoded.gzipETag if useGzip else encoded.etag
+
+        request.setHeader(b'vary', b'Accept-Encoding')
+        request.setHeader(b'etag', etag)
+        request.setHeader(b'cache-control', b'no-cache')
+
+        ifNoneMatch = request.getHeader(b'if-none-match')
+        if ifNoneMatch and _etagMatches(ifNoneMatch, etag):
+            request.setResponseCode(304)
+            return b''
+
+        request.setHeader(b'content-type', encoded.contentType)
+        if useGzip:
+            request.setHeader(b'content-encoding', b'gzip')
+            return encoded.gzipped
+        return encoded.data
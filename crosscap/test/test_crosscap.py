@@ -0,0 +1,35 @@
+"""
+Tests of the crosscap package namespace
+"""
+import subprocess
+import sys
+
+from pytest import raises
+
+import crosscap
+
+
+def test_lazyImports():
+    """
+    Do I put off importing yaml, click and friends until the features using them are used?
+    """
+    script = '\n'.join([
+        'import sys',
+        'import crosscap, crosscap.tree, crosscap.permitting',
+        'print(sorted(m for m in ("yaml", "click", "ftfy", "pkg_resources", "crosscap.urltool") if m in sys.modules))',
+        'crosscap.urltool',
+        'print("crosscap.urltool" in sys.modules and "yaml" in sys.modules)',
+        ])
+    out = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+    assert out.splitlines() == ['[]', 'True']
+
+
+def test_getattr():
+    """
+    Do I import names when they are used, and only names I know about?
+    """
+    from crosscap import tree
+    assert crosscap.enter is tree.enter
+    assert 'urltool' in dir(crosscap)
+    with raises(AttributeError):
+        crosscap.nothing
@@ -53,3 +53,8 @@ def test_documentation():
     strDoc = doc.Documentation.fromObject(StrClsWithUTF8, decode=True)
     assert strDoc.first == u'I have a 😼💫 docstring'
     assert type(strDoc.first) is type(u'')
+
+    class Undocumented(object):
+        pass
+
+    assert doc.Documentation.fromObject(Undocumented).raw == ''
@@ -3,10 +3,13 @@ Tests of the openapi schema in kleinish
 """
 from collections import OrderedDict
 from inspect import cleandoc
+import json
+
+from mock import patch
 
 import yaml
 
-from crosscap import openapi
+from crosscap import openapi, yamlhack
 
 
 def test_orderedDict():
@@ -20,7 +23,7 @@ def test_orderedDict():
     dct['y'] = 4
     dct['c'] = 5
     dct['x'] = 6
-    assert yaml.dump(dct, default_flow_style=False) == cleandoc('''
+    assert yamlhack.dump(dct) == cleandoc('''
         a: 1
         z: 2
         b: 3
@@ -36,19 +39,107 @@ def test_helperMediaTypes():
     """
     h1 = openapi.textHTML()
     assert isinstance(h1, openapi.OpenAPIResponses)
-    assert yaml.load(yaml.dump(h1)) == {
+    assert yaml.safe_load(yamlhack.dump(h1)) == {
         'default': {'content': {'text/html': {}}}
     }
     h2 = openapi.textHTML({'a': 1})
-    assert yaml.load(yaml.dump(h2)) == {
+    assert yaml.safe_load(yamlhack.dump(h2)) == {
         'default': {'content': {'text/html': {'a': 1}}}
     }
     j1 = openapi.applicationJSON()
     assert isinstance(j1, openapi.OpenAPIResponses)
-    assert yaml.load(yaml.dump(j1)) == {
+    assert yaml.safe_load(yamlhack.dump(j1)) == {
         'default': {'content': {'application/json': {}}}
     }
     j2 = openapi.applicationJSON({'a': 1})
-    assert yaml.load(yaml.dump(j2)) == {
+    assert yaml.safe_load(yamlhack.dump(j2)) == {
         'default': {'content': {'application/json': {'a': 1}}}
     }
+
+
+def test_toJSON():
+    """
+    Do I convert OpenAPI objects to JSON with the same content as their yaml?
+    """
+    op = openapi.OpenAPIOperation(summary=u'Sumæry', parameters=[openapi.queryParameter('color', required=True)])
+    op.responses = openapi.applicationJSON({'schema': {'type': 'object'}})
+    op._extended['x-fish'] = ['red', 'blue']
+    item = openapi.OpenAPIPathItem()
+    item.addOperation('put', openapi.OpenAPIOperation(operationId='put'))
+    item.addOperation('get', op)
+    spec = openapi.OpenAPI()
+    spec.paths['/fish'] = item
+    spec.paths['/empty'] = openapi.OpenAPIPathItem()
+
+    data = openapi.toDict(spec)
+    assert list(data['paths']['/fish']) == ['get', 'put']
+    assert data['paths']['/fish']['get']['parameters'] == [{'name': 'color', 'in': 'query', 'required': True}]
+
+    encoded = openapi.toJSON(spec)
+    assert json.loads(encoded.decode('utf-8')) == yaml.safe_load(yamlhack.dump(spec))
+    assert u'Sumæry'.encode('utf-8') in encoded
+
+    # the json module writes the same thing as orjson
+    with patch.object(openapi, 'orjson', None):
+        assert openapi.toJSON(spec) == encoded
+
+
+def test_toDictEmpty():
+    """
+    Do I leave out empty attributes, including OpenAPI objects with only empty attributes, and
+    keep aliases for objects found twice?
+    """
+    shared = ['a', 'b']
+    op = openapi.OpenAPIOperation(tags=shared, responses=openapi.OpenAPIResponses())
+    op._extended['x-shared'] = shared
+    op._extended['summary'] = 'overridden'
+    op._extended['x-empty'] = ()
+    op._extended['x-empty2'] = ()
+    op.callbacks['media'] = openapi.OpenAPIMediaType()
+    op2 = openapi.OpenAPIOperation(deprecated=True)
+    op2.responses = openapi.OpenAPIResponses(codeMap=OrderedDict([(200, openapi.OpenAPIResponse('ok'))]))
+    item = openapi.OpenAPIPathItem()
+    item.addOperation('post', op)
+    item.addOperation('get', op2)
+    item.addOperation('summary', op2)
+    spec = openapi.OpenAPI()
+    spec.info.contact = openapi.OpenAPIInfo()
+    spec.paths['/b'] = item
+    spec.paths['/a'] = openapi.OpenAPIPathItem()
+
+    data = openapi.toDict(spec)
+    assert data['paths']['/b']['get'] is data['paths']['/b']['summary']
+    assert data['paths']['/b']['post']['x-empty'] is not data['paths']['/b']['post']['x-empty2']
+    assert yamlhack.dump(spec) == cleandoc('''
+        openapi: 3.0.0
+        info:
+          title: TODO
+          contact:
+            title: TODO
+            version: TODO
+          version: TODO
+        paths:
+          /b:
+            get: &id002
+              summary: undocumented
+              description: undocumented
+              responses:
+                codeMap:
+                  200:
+                    description: ok
+              deprecated: true
+            post:
+              tags: &id001
+              - a
+              - b
+              summary: overridden
+              description: undocumented
+              responses: {}
+              callbacks:
+                media: {}
+              x-shared: *id001
+              x-empty: []
+              x-empty2: []
+            summary: *id002
+          /a: {}
+        ''') + '\n'
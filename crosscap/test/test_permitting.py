@@ -2,21 +2,32 @@
 """
 Confirmation of the permitting API
 """
+import asyncio
 from datetime import datetime
+import json
 import time
 
 from builtins import object
 
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
 import jwt
 
+from klein import Klein
+
+from twisted.internet import defer
 from twisted.python import components
+from twisted.web.iweb import IRequest
 from twisted.web.test.requesthelper import DummyRequest
 
-from pytest import fixture, mark, raises
+from pytest import fixture, inlineCallbacks, mark, raises
 
-from mock import Mock
+from mock import Mock, patch
 
-from crosscap import permitting
+from zope.interface import implementer
+
+from crosscap import permitting, tree
 from crosscap.testing import request as ctrequest
 
 
@@ -50,6 +61,92 @@ class AuthUser(object):
 components.registerAdapter(AuthUser, DummyRequest, permitting.ICurrentUser)
 
 
+def _coro(value):
+    """
+    An awaitable of value, without async syntax
+    """
+    return asyncio.sleep(0, result=value)
+
+
+def _resolve(result):
+    """
+    Get the eventual value of a Deferred or coroutine returned by a permits()-decorated function
+    """
+    if isinstance(result, defer.Deferred):
+        got = []
+        result.addBoth(got.append)
+        return got[0]
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(result)
+    finally:
+        loop.close()
+
+
+class LaterPage(object):
+    """
+    A request handler for an ICurrentUser that answers with Deferreds or awaitables
+    """
+    def __init__(self, user, later, accept=True):
+        self.user = user
+        self.later = later
+        self.accept = accept
+
+
+class LaterAuthUser(AuthUser):
+    def authenticate(self):
+        return self.req.later(AuthUser.authenticate(self))
+
+    def authenticated(self, user):
+        return self.req.later(Y if self.req.accept else None)
+
+components.registerAdapter(LaterAuthUser, LaterPage, permitting.ICurrentUser)
+
+
+class CountingAuthUser(AuthUser):
+    """
+    An AuthUser that counts authentications on its request
+    """
+    def authenticate(self):
+        self.req.authentications += 1
+        return AuthUser.authenticate(self)
+
+
+@implementer(IRequest)
+class NestedRequest(DummyRequest):
+    authentications = 0
+
+components.registerAdapter(CountingAuthUser, NestedRequest, permitting.ICurrentUser)
+
+
+class ProtectedTop(object):
+    app = Klein()
+
+    @app.route('/billing/', branch=True)
+    @permitting.permits()
+    @tree.enter('crosscap.test.test_permitting.ProtectedSub')
+    def billing(self, request, subKlein):
+        return subKlein
+
+
+class ProtectedSub(object):
+    app = Klein()
+
+    @app.route('/invoices')
+    @permitting.permits(permitting.role_in([BILLING_CONTACT]))
+    def invoices(self, request):
+        return Y
+
+
+@fixture(scope='module')
+def rsa_keys():
+    """
+    Two RSA private keys, to sign tokens with during a key rotation
+    """
+    return [rsa.generate_private_key(public_exponent=65537, key_size=2048) for n in range(2)]
+
+
 @fixture
 def u_admin():
     """
@@ -58,6 +155,14 @@ def u_admin():
     return Mock(roles=[ADMIN], userID='luigi')
 
 
+@fixture
+def u_billing():
+    """
+    An instance of authuser with the billing role
+    """
+    return Mock(roles=[BILLING_CONTACT], userID='mario')
+
+
 @fixture
 def u_user():
     """
@@ -85,6 +190,46 @@ def test_role_in(u_admin, u_user):
     assert permitting.role_in([ADMIN, BILLING_CONTACT])(u_admin)
 
 
+def test_role_hierarchy(u_admin, u_user):
+    """
+    Do users have the roles implied by their roles, and do I read their roles only once?
+    """
+    hierarchy = permitting.RoleHierarchy({
+        ADMIN: ['editor', BILLING_CONTACT],
+        'editor': ['viewer'],
+        'viewer': ['editor'],
+        })
+    assert hierarchy.closure[ADMIN] == {ADMIN, 'editor', 'viewer', BILLING_CONTACT}
+    assert hierarchy.closure['viewer'] == {'editor', 'viewer'}
+    assert hierarchy.expand(['waaa']) == {'waaa'}
+
+    assert permitting.role_in(['viewer'], hierarchy)(u_admin)
+    assert not permitting.role_in(['viewer'])(u_admin)
+    assert not permitting.role_in(['viewer'], hierarchy)(u_user)
+
+    class CountingUser(object):
+        reads = 0
+
+        @property
+        def roles(self):
+            self.reads += 1
+            return ['editor']
+
+    authuser = CountingUser()
+    assert permitting.effective_roles(authuser, hierarchy) == {'editor', 'viewer'}
+    assert permitting.role_in(['viewer'], hierarchy)(authuser)
+    assert permitting.role_in(['editor'])(authuser)
+    assert not permitting.role_in([ADMIN])(authuser)
+    assert authuser.reads == 1
+
+    # nowhere to remember the roles, so they are read every time
+    class SlottedUser(object):
+        __slots__ = ()
+        roles = ['editor']
+
+    assert permitting.role_in(['viewer'], hierarchy)(SlottedUser())
+
+
 def test_create_timed_token():
     """
     Do I generate a sensible output or error for various calls
@@ -112,6 +257,41 @@ def test_create_timed_token():
         permitting.create_timed_token('', SECRET)
 
 
+def test_create_timed_tokens():
+    """
+    Do I issue many tokens at once, sharing one expiration time?
+    """
+    exp = int(time.time() + permitting.core.JWT_DURATION)
+    subs = ['user%d' % n for n in range(5)]
+
+    with patch.object(permitting.core, 'validate_token', wraps=permitting.validate_token) as m_validate:
+        toks = permitting.create_timed_tokens(subs, SECRET)
+        assert not m_validate.called
+        toks = list(toks)
+    assert m_validate.call_count == 1
+
+    payloads = [jwt.decode(t, SECRET, algorithms=permitting.core.JWT_ALGO) for t in toks]
+    assert [p['sub'] for p in payloads] == subs
+    assert len(set(p['exp'] for p in payloads)) == 1
+    assert abs(payloads[0]['exp'] - exp) <= 1
+
+    # no expiration, different algorithm, no self-check
+    with patch.object(permitting.core, 'validate_token') as m_validate:
+        toks = list(permitting.create_timed_tokens(subs, SECRET, duration=None, verify=0, algorithm='HS512'))
+    assert not m_validate.called
+    assert jwt.decode(toks[-1], SECRET, algorithms=['HS512']) == {'sub': 'user4'}
+
+    # an algorithm jwt doesn't know about
+    with raises(NotImplementedError):
+        list(permitting.create_timed_tokens(subs, SECRET, algorithm='XX999'))
+
+    with raises(TypeError):
+        permitting.create_timed_tokens(subs, '')
+
+    with raises(TypeError):
+        list(permitting.create_timed_tokens(['myuser', ''], SECRET))
+
+
 def test_validate_token():
     """
     Do valid tokens pass our validator function? Also invalid tokens, not pass
@@ -147,6 +327,216 @@ def test_validate_token():
     assert permitting.validate_token(None, SECRET, _my_default) is _my_default
 
 
+def test_keyring(rsa_keys):
+    """
+    Do I verify each token with the key named by its kid, during a key rotation?
+    """
+    old, new = rsa_keys
+    ring = permitting.KeyRing(default_kid='old')
+    ring.add('old', old.public_key(), 'RS256')
+    ring.add('new', new.public_key(), 'RS256')
+    ring.add('shared', SECRET, 'HS512')
+    assert len(ring) == 3 and 'new' in ring
+
+    tok_old = jwt.encode({'sub': 'mario'}, old, algorithm='RS256', headers={'kid': 'old'})
+    tok_new = jwt.encode({'sub': 'luigi'}, new, algorithm='RS256', headers={'kid': 'new'})
+    tok_nokid = jwt.encode({'sub': 'peach'}, old, algorithm='RS256')
+    tok_hmac = jwt.encode({'sub': 'toad'}, SECRET, algorithm='HS512', headers={'kid': 'shared'})
+    assert permitting.validate_token(tok_old, ring)['sub'] == 'mario'
+    assert permitting.validate_token(tok_new, ring)['sub'] == 'luigi'
+    assert permitting.validate_token(tok_nokid, ring)['sub'] == 'peach'
+    assert permitting.validate_token(tok_hmac, ring)['sub'] == 'toad'
+
+    # signed by the wrong key
+    tok_forged = jwt.encode({'sub': 'wario'}, new, algorithm='RS256', headers={'kid': 'old'})
+    assert permitting.validate_token(tok_forged, ring, None) is None
+
+    # the algorithm comes from the ring, not the token
+    tok_confused = jwt.encode({'sub': 'wario'}, SECRET, algorithm='HS256', headers={'kid': 'shared'})
+    assert permitting.validate_token(tok_confused, ring, None) is None
+    assert permitting.validate_token(tok_confused, ring, None, algorithms=['HS256', 'HS512']) is None
+    assert permitting.validate_token(tok_hmac, ring, algorithms=['HS256'])['sub'] == 'toad'
+
+    # the old key is retired
+    ring.remove('old')
+    with raises(jwt.exceptions.InvalidKeyError):
+        permitting.validate_token(tok_old, ring)
+    assert permitting.validate_token(tok_nokid, ring, None) is None
+
+    # a cache works with key rings too
+    cache = permitting.TokenCache()
+    for n in range(2):
+        assert permitting.validate_token(tok_new, ring, cache=cache)['sub'] == 'luigi'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    with raises(NotImplementedError):
+        ring.add('bogus', SECRET, 'XX999')
+
+
+def test_keyring_jwks(tmp_path, rsa_keys):
+    """
+    Do I load a key ring from a JWKS file?
+    """
+    ec_key = ec.generate_private_key(ec.SECP384R1())
+    ed_key = ed25519.Ed25519PrivateKey.generate()
+    rsa_jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(rsa_keys[0].public_key()))
+    rsa_jwk['kid'] = 'rsa'
+    ec_jwk = json.loads(jwt.algorithms.ECAlgorithm.to_jwk(ec_key.public_key()))
+    ec_jwk['kid'] = 'ec'
+    hmac_jwk = json.loads(jwt.algorithms.HMACAlgorithm.to_jwk(SECRET))
+    hmac_jwk.update(kid='hmac', alg='HS384')
+    ed_jwk = json.loads(jwt.algorithms.OKPAlgorithm.to_jwk(ed_key.public_key()))
+    ed_jwk['kid'] = 'ed'
+    path = tmp_path / 'jwks.json'
+    path.write_text(json.dumps({'keys': [rsa_jwk, ec_jwk, hmac_jwk, ed_jwk]}))
+
+    ring = permitting.KeyRing.from_jwks_file(str(path), default_kid='rsa')
+    assert len(ring) == 4
+
+    tok_rsa = jwt.encode({'sub': 'mario'}, rsa_keys[0], algorithm='RS256')
+    tok_ec = jwt.encode({'sub': 'luigi'}, ec_key, algorithm='ES384', headers={'kid': 'ec'})
+    tok_hmac = jwt.encode({'sub': 'toad'}, SECRET, algorithm='HS384', headers={'kid': 'hmac'})
+    assert permitting.validate_token(tok_rsa, ring)['sub'] == 'mario'
+    assert permitting.validate_token(tok_ec, ring)['sub'] == 'luigi'
+    assert permitting.validate_token(tok_hmac, ring)['sub'] == 'toad'
+    tok_ed = jwt.encode({'sub': 'peach'}, ed_key, algorithm='EdDSA', headers={'kid': 'ed'})
+    assert permitting.validate_token(tok_ed, ring)['sub'] == 'peach'
+
+    for jwk in dict(ec_jwk, crv='P-999'), dict(ed_jwk, kty='XYZ'):
+        with raises(jwt.exceptions.InvalidKeyError):
+            permitting.KeyRing.from_jwks({'keys': [jwk]})
+
+
+def test_revocation():
+    """
+    Do I reject revoked tokens, even from the cache, and forget them once they expire?
+    """
+    now = [time.time()]
+    revoked = permitting.RevocationIndex(clock=lambda: now[0])
+    cache = permitting.TokenCache()
+    iat = int(now[0])
+    exp = iat + 60
+    tok_jti = jwt.encode({'sub': 'mario', 'jti': 'j1', 'exp': exp}, SECRET, algorithm='HS256')
+    tok_iat = jwt.encode({'sub': 'luigi', 'iat': iat, 'exp': exp}, SECRET, algorithm='HS256')
+    tok_other = jwt.encode({'sub': 'luigi', 'iat': iat - 1}, SECRET, algorithm='HS256')
+
+    # nothing revoked yet
+    assert permitting.validate_token(tok_jti, SECRET, revoked=revoked, cache=cache)['sub'] == 'mario'
+    assert permitting.validate_token(tok_iat, SECRET, revoked=revoked)['sub'] == 'luigi'
+
+    revoked.revoke(permitting.validate_token(tok_jti, SECRET))
+    revoked.revoke(permitting.validate_token(tok_iat, SECRET))
+    revoked.revoke({'sub': 'luigi', 'iat': iat - 2}) # never expires
+    revoked.revoke({'sub': 'peach', 'iat': iat, 'exp': exp})
+    assert len(revoked) == 4
+
+    with raises(permitting.TokenRevoked):
+        permitting.validate_token(tok_jti, SECRET, revoked=revoked, cache=cache)
+    assert cache.hits == 1
+    assert permitting.validate_token(tok_iat, SECRET, None, revoked=revoked) is None
+    assert permitting.validate_token(tok_other, SECRET, revoked=revoked)['sub'] == 'luigi'
+
+    # revoked again with a later expiration, so pruning the first revocation keeps it
+    revoked.revoke({'jti': 'j1', 'exp': exp + 60})
+
+    now[0] += 61
+    revoked.prune()
+    assert len(revoked) == 2
+    assert revoked.is_revoked({'jti': 'j1'})
+    assert not revoked.is_revoked({'sub': 'luigi', 'iat': iat})
+
+    now[0] += 60
+    revoked.prune()
+    assert len(revoked) == 1
+    assert not revoked.is_revoked({'jti': 'j1'})
+
+    with raises(ValueError):
+        revoked.revoke({'sub': 'luigi'})
+
+
+@fixture
+def verifier():
+    verifier = permitting.ThreadedVerifier(size=2)
+    yield verifier
+    verifier.stop()
+
+
+@inlineCallbacks
+def test_threaded_verifier_deferred(verifier, rsa_keys):
+    """
+    Do I verify RSA tokens on a worker thread, and HMAC tokens inline?
+    """
+    ring = permitting.KeyRing()
+    ring.add('rsa', rsa_keys[0].public_key(), 'RS256')
+    tok_rsa = jwt.encode({'sub': 'mario'}, rsa_keys[0], algorithm='RS256', headers={'kid': 'rsa'})
+    tok_hmac = permitting.create_timed_token('luigi', SECRET)
+
+    assert not verifier.is_inline(tok_rsa, ring)
+    assert verifier.is_inline(tok_hmac, SECRET)
+    assert verifier.is_inline('garbage', SECRET)
+
+    d = verifier.validate_token_deferred(tok_rsa, ring)
+    assert not d.called
+    payload = yield d
+    assert payload['sub'] == 'mario'
+    assert verifier._threadpool is not None
+
+    d = verifier.validate_token_deferred(tok_hmac, SECRET)
+    assert d.called
+    payload = yield d
+    assert payload['sub'] == 'luigi'
+
+    assert (yield verifier.validate_token_deferred(tok_rsa[:-4], ring, None)) is None
+    with raises(jwt.exceptions.DecodeError):
+        yield verifier.validate_token_deferred('garbage', SECRET)
+
+
+def test_threaded_verifier_future(verifier, rsa_keys):
+    """
+    Do I verify tokens with asyncio futures?
+    """
+    tok_rsa = jwt.encode({'sub': 'mario'}, rsa_keys[0], algorithm='RS256')
+    tok_hmac = permitting.create_timed_token('luigi', SECRET)
+    public_pem = rsa_keys[0].public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    async def verify():
+        future = verifier.validate_token_future(tok_rsa, public_pem, algorithms=['RS256'])
+        assert (await future)['sub'] == 'mario'
+        assert verifier._executor is not None
+
+        future = verifier.validate_token_future(tok_hmac, SECRET)
+        assert future.done()
+        assert (await future)['sub'] == 'luigi'
+
+        future = verifier.validate_token_future('garbage', SECRET)
+        with raises(jwt.exceptions.DecodeError):
+            await future
+
+        # other errors come through the future too
+        future = verifier.validate_token_future(tok_hmac, 12345)
+        with raises(TypeError):
+            await future
+
+    _resolve(verify())
+
+    # only from a running event loop
+    with raises(RuntimeError):
+        verifier.validate_token_future(tok_hmac, SECRET)
+
+
+def test_threaded_verifier_reactor():
+    """
+    Do I stop my thread pool when the reactor shuts down?
+    """
+    reactor = Mock()
+    verifier = permitting.ThreadedVerifier(reactor=reactor)
+    verifier._start_threadpool()
+    reactor.addSystemEventTrigger.assert_called_once_with('during', 'shutdown', verifier.stop)
+    verifier.stop()
+    assert verifier._threadpool is None
+
+
 def test_extract_bearer_token():
     """
     Do I parse an authorization header with a bearer token correctly, returning just the token
@@ -252,6 +642,76 @@ def test_permits_tornadolike(u_user):
     assert pg.handler() == Y
 
 
+@inlineCallbacks
+@mark.parametrize("who,expect", [
+    ["u_billing", Y],
+    ["u_admin", N],
+    ])
+def test_permits_nested(request, who, expect):
+    """
+    Do I authenticate only once, when a request passes through nested permits() layers?
+    """
+    req = NestedRequest([])
+    req.user = request.getfixturevalue(who)
+
+    subKlein = yield ProtectedTop().app.execute_endpoint('billing', req)
+    res = yield subKlein._app.execute_endpoint('invoices', req)
+    assert res == expect
+    assert req.authentications == 1
+
+    # a new request is authenticated again
+    req2 = NestedRequest([])
+    req2.user = req.user
+    yield ProtectedTop().app.execute_endpoint('billing', req2)
+    assert req2.authentications == 1
+
+
+def test_permits_sharedHandler(u_user, u_hacker):
+    """
+    Do I authenticate every call when the handler isn't a request, and may live across requests?
+    """
+    class SharedPage(object):
+        authentications = 0
+        user = u_user
+
+        @permitting.permits()
+        def handler(self):
+            return Y
+
+        @permitting.permits()
+        def outer(self):
+            return self.handler()
+
+        @permitting.permits()
+        def route(self, request):
+            return self.routeInner(request)
+
+        @permitting.permits()
+        def routeInner(self, request):
+            return Y
+
+    components.registerAdapter(CountingAuthUser, SharedPage, permitting.ICurrentUser)
+
+    page = SharedPage()
+    assert page.outer() == Y
+    assert page.authentications == 2
+    page.user = u_hacker
+    assert page.handler() == N
+    assert page.authentications == 3
+
+    # but the request of a tornado-style handler remembers it
+    page.request = NestedRequest([])
+    page.user = u_user
+    assert page.outer() == Y
+    assert page.authentications == 4
+
+    # as does a request passed to a method of a shared app (Klein)
+    del page.request
+    assert page.route(NestedRequest([])) == Y
+    assert page.route(NestedRequest([])) == Y
+    assert page.authentications == 6
+
+
 def test_permits_badfunction():
     """
     Do I raise an appropriate exception when the decorator is used on something inappropriate?
@@ -262,3 +722,384 @@ def test_permits_badfunction():
 
     with raises(TypeError):
         handler()
+
+
+def test_token_cache():
+    """
+    Do I answer repeat validations from the cache, and stop once the token expires?
+    """
+    now = [time.time()]
+    cache = permitting.TokenCache(maxsize=2, clock=lambda: now[0])
+    tok = permitting.create_timed_token('myuser', SECRET, duration=60)
+
+    payload = permitting.validate_token(tok, SECRET, cache=cache)
+    assert payload['sub'] == 'myuser'
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    payload['sub'] = 'tampered'
+    assert permitting.validate_token(tok, SECRET, cache=cache)['sub'] == 'myuser'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # different options or a different secret are different cache entries
+    permitting.validate_token(tok, SECRET, cache=cache, leeway=5)
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert permitting.validate_token(tok, SECRET[:-2], None, cache=cache) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # options that can't be hashed bypass the cache
+    assert permitting.validate_token(tok, SECRET, None, cache=cache, issuer=bytearray()) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+    permitting.validate_token(tok, SECRET, cache=cache, options={'require': ['sub']})
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # after exp, the cached payload is dropped and the token is verified again
+    now[0] += 61
+    permitting.validate_token(tok, SECRET, cache=cache)
+    assert cache.misses == 5
+    assert cache.stats() == {'hits': 1, 'misses': 5, 'negative_hits': 0, 'size': 2, 'negative_size': 1}
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_token_cache_negative():
+    """
+    Do I remember rejected tokens for a while, and evict the least-recently used tokens?
+    """
+    now = [time.time()]
+    cache = permitting.TokenCache(maxsize=1, negative_maxsize=1, negative_ttl=10, clock=lambda: now[0])
+    bad = permitting.create_timed_token('myuser', SECRET + 'x')
+
+    for n in range(2):
+        with raises(jwt.exceptions.InvalidSignatureError):
+            permitting.validate_token(bad, SECRET, cache=cache)
+    assert (cache.negative_hits, cache.misses) == (1, 1)
+
+    now[0] += 11
+    assert permitting.validate_token(bad, SECRET, 'nope', cache=cache) == 'nope'
+    assert cache.misses == 2
+
+    tok1 = permitting.create_timed_token('one', SECRET, duration=None)
+    tok2 = permitting.create_timed_token('two', SECRET, duration=None)
+    permitting.validate_token(tok1, SECRET, cache=cache)
+    permitting.validate_token(tok2, SECRET, cache=cache)
+    permitting.validate_token(tok1, SECRET, cache=cache)
+    assert (len(cache), cache.hits, cache.misses) == (1, 0, 5)
+
+    nocache = permitting.TokenCache(maxsize=0)
+    permitting.validate_token(tok1, SECRET, cache=nocache)
+    permitting.validate_token(tok1, SECRET, cache=nocache)
+    assert (len(nocache), nocache.misses) == (0, 2)
+
+
+def test_permits_handler_cache(u_user):
+    """
+    Do I remember where the handler is, and notice adapters that are registered later?
+    """
+    class LatePage(object):
+        user = u_user
+
+    @permitting.permits()
+    def handler(page):
+        return Y
+
+    with raises(TypeError):
+        handler(LatePage())
+
+    components.registerAdapter(AuthUser, LatePage, permitting.ICurrentUser)
+    assert handler(LatePage()) == Y
+
+    with patch.object(permitting.core, 'getAdapterFactory') as m_getAdapterFactory:
+        assert handler(LatePage()) == Y
+    assert not m_getAdapterFactory.called
+
+    # too many distinct shapes forgets the old ones
+    with patch.object(permitting.core, '_MAX_HANDLER_SHAPES', 1):
+        req = ctrequest([])
+        req.user = u_user
+        assert handler(req) == Y
+        assert handler(LatePage()) == Y
+
+
+@mark.parametrize("later", [defer.succeed, _coro])
+@mark.parametrize("who,accept,rules,expect", [
+    # authenticated, no rules
+    ["u_admin", True, [], Y],
+
+    # authenticated, passes a rule that answers later
+    ["u_admin", True, [lambda au: au.req.later(ADMIN in au.roles)], Y],
+
+    # authenticated, fails a rule that answers later, after a synchronous rule
+    ["u_user", True, [lambda au: True, lambda au: au.req.later(ADMIN in au.roles)], N],
+
+    # authenticated, fails a synchronous rule after a rule that answers later
+    ["u_user", True, [lambda au: au.req.later(True), permitting.role_in([ADMIN])], N],
+
+    # authenticated, passes a coroutine rule no matter what the ICurrentUser returns
+    ["u_user", True, [lambda au: _coro(True)], Y],
+
+    # not authenticated
+    ["u_hacker", True, [], N],
+
+    # authenticated() rejects the user
+    ["u_admin", False, [], N],
+    ])
+def test_permits_later(request, later, who, accept, rules, expect):
+    """
+    Do I wait for Deferreds and awaitables from the ICurrentUser and the rules, instead of blocking?
+    """
+    page = LaterPage(request.getfixturevalue(who), later, accept)
+
+    @permitting.permits(*rules)
+    def handler(page):
+        return Y
+
+    result = handler(page)
+    assert permitting.chain.is_async(result)
+    assert _resolve(result) == expect
+
+
+def test_permits_rejected(u_admin):
+    """
+    Do I forbid access when authenticated() rejects the user synchronously?
+    """
+    class RejectingAuthUser(AuthUser):
+        def authenticated(self, user):
+            return None
+
+    class RejectedPage(object):
+        user = u_admin
+
+    components.registerAdapter(RejectingAuthUser, RejectedPage, permitting.ICurrentUser)
+
+    @permitting.permits()
+    def handler(page): # pragma: nocover
+        return Y
+
+    assert handler(RejectedPage()) == N
+
+
+def test_is_async():
+    """
+    Do I tell results apart from Deferreds and awaitables, even for types I've seen before?
+    """
+    is_async = permitting.chain.is_async
+    for n in range(2):
+        assert not is_async(AuthUser(None))
+        assert not is_async(x for x in [])
+        assert is_async(defer.succeed(1))
+        coro = _coro(1)
+        assert is_async(coro)
+        coro.close()
+
+
+@fixture
+def recorder():
+    """
+    An InMemoryMetrics that is installed for the duration of the test
+    """
+    recorder = permitting.metrics.InMemoryMetrics()
+    permitting.metrics.install(recorder)
+    yield recorder
+    permitting.metrics.install(None)
+
+
+def test_permits_metrics(recorder, u_admin, u_billing, u_user, u_hacker):
+    """
+    Do I time each phase of a request, and count the outcomes?
+    """
+    @permitting.permits(permitting.role_in([ADMIN]))
+    def handler(page):
+        return page.later(Y)
+
+    label = 'crosscap.test.test_permitting.test_permits_metrics.<locals>.handler'
+    ticks = iter(range(100))
+    with patch.object(permitting.metrics, 'clock', lambda: next(ticks) * 0.001):
+        assert handler(LaterPage(u_admin, lambda v: v)) == Y
+        assert _resolve(handler(LaterPage(u_admin, defer.succeed))) == Y
+        assert handler(LaterPage(u_user, lambda v: v)) == N
+        assert handler(LaterPage(u_hacker, lambda v: v)) == N
+
+    got = recorder.as_dict()[label]
+    assert got['outcomes'] == {'allowed': 2, 'forbidden': 2}
+    assert got['latency']['authn']['count'] == 4
+    assert got['latency']['authz']['count'] == 3
+    assert got['latency']['handler'] == {
+        'count': 2,
+        'sum': 0.002,
+        'buckets': dict((k, 0 if k in ('0.0001', '0.00025', '0.0005') else 2)
+            for k in (permitting.metrics._bucket_label(b) for b in permitting.metrics.BUCKETS)),
+        }
+
+    assert json.loads(recorder.dump_json())[label]['outcomes']['forbidden'] == 2
+    text = recorder.dump_text()
+    assert 'permits_requests_total{function="%s",outcome="allowed"} 2\n' % label in text
+    assert 'permits_seconds_bucket{function="%s",phase="handler",le="+Inf"} 2\n' % label in text
+    assert 'permits_seconds_count{function="%s",phase="authn"} 4\n' % label in text
+
+    # an outer permits() layer already authenticated, so the inner layer starts with authz
+    req = NestedRequest([])
+    req.user = u_billing
+    subKlein = ProtectedTop().app.execute_endpoint('billing', req)
+    assert subKlein._app.execute_endpoint('invoices', req) == Y
+    inner = recorder.as_dict()['crosscap.test.test_permitting.ProtectedSub.invoices']
+    assert sorted(inner['latency']) == ['authz', 'handler']
+
+    permitting.metrics.install(None)
+    assert handler(LaterPage(u_admin, lambda v: v)) == Y
+    assert recorder.as_dict()[label]['outcomes'] == {'allowed': 2, 'forbidden': 2}
+
+
+def test_permits_metrics_errors(recorder, u_admin):
+    """
+    Do I time the phase and count an error when authenticating, the rules, or the handler raise, or
+    their Deferred or awaitable fails?
+    """
+    @permitting.permits(permitting.role_in([ADMIN]))
+    def handler(page, answer):
+        return answer()
+
+    def raising():
+        raise ValueError("oops")
+
+    async def failingLater():
+        await _coro(None)
+        raise ValueError("oops")
+
+    label = 'crosscap.test.test_permitting.test_permits_metrics_errors.<locals>.handler'
+    page = lambda: LaterPage(u_admin, lambda v: v)
+    with raises(ValueError):
+        handler(page(), raising)
+    assert _resolve(handler(page(), lambda: defer.fail(ValueError("oops")))).check(ValueError)
+    with raises(ValueError):
+        _resolve(handler(page(), failingLater))
+    assert _resolve(handler(page(), lambda: _coro(Y))) == Y
+
+    got = recorder.as_dict()[label]
+    assert got['outcomes'] == {'error': 3, 'allowed': 1}
+    assert got['latency']['handler']['count'] == 4
+    assert 'outcome="error"} 3\n' in recorder.dump_text()
+
+    # failed logins, and rules that fail
+    def raisingLogin(value):
+        raise ValueError("oops")
+
+    async def failingLogin(value):
+        await _coro(value)
+        raise ValueError("oops")
+
+    @permitting.permits(lambda authuser: raisingLogin(None))
+    def checked(page): # pragma: nocover
+        return Y
+
+    with raises(ValueError):
+        handler(LaterPage(u_admin, raisingLogin), lambda: Y)
+    assert _resolve(handler(LaterPage(u_admin, lambda v: defer.fail(ValueError("oops"))), lambda: Y)).check(ValueError)
+    with raises(ValueError):
+        _resolve(handler(LaterPage(u_admin, failingLogin), lambda: Y))
+    with raises(ValueError):
+        checked(page())
+
+    got = recorder.as_dict()[label]
+    assert got['outcomes'] == {'error': 6, 'allowed': 1}
+    assert got['latency']['authn']['count'] == 7
+    assert got['latency']['handler']['count'] == 4
+    got = recorder.as_dict()[label.replace('handler', 'checked')]
+    assert got['outcomes'] == {'error': 1}
+    assert sorted(got['latency']) == ['authn', 'authz']
+
+
+def test_rule_combinators(u_admin, u_user):
+    """
+    Do I check cheap rules first, skip rules when the answer is known, and check pure rules once?
+    """
+    checked = []
+
+    def tracking(name, passed, later=lambda v: v):
+        def _rule(authuser):
+            checked.append(name)
+            return later(passed)
+        return _rule
+
+    expensive = permitting.costs(100)(tracking('expensive', True))
+    cheap = permitting.costs(1)(tracking('cheap', False))
+    middling = permitting.costs(permitting.rules.DEFAULT_COST)(tracking('middling', True))
+
+    assert not permitting.all_of(expensive, middling, cheap)(u_admin)
+    assert checked == ['cheap']
+
+    # rules without a cost keep the order they were given in
+    del checked[:]
+    plain = tracking('plain', True)
+    assert permitting.rules.cost_of(plain) == permitting.rules.DEFAULT_COST
+    assert not permitting.all_of(expensive, plain, cheap)(u_admin)
+    assert checked == ['expensive', 'plain', 'cheap']
+    del checked[:]
+    assert not permitting.any_of(permitting.not_(plain), permitting.all_of(plain, expensive, cheap))(u_admin)
+    assert checked == ['plain', 'plain', 'expensive', 'cheap']
+    assert not hasattr(permitting.all_of(plain, cheap), 'crosscap_cost')
+
+    del checked[:]
+    assert permitting.any_of(expensive, middling, cheap)(u_admin)
+    assert checked == ['cheap', 'middling']
+
+    del checked[:]
+    assert not permitting.any_of(cheap, permitting.not_(expensive))(u_admin)
+    assert checked == ['cheap', 'expensive']
+    assert permitting.not_(cheap)(u_admin)
+
+    assert permitting.all_of()(u_admin)
+    assert not permitting.any_of()(u_admin)
+
+    # combinations cost as much as their parts, and are pure if their parts are
+    admin = permitting.role_in([ADMIN])
+    combined = permitting.all_of(admin, permitting.not_(permitting.role_in([BILLING_CONTACT])))
+    assert (combined.crosscap_cost, combined.crosscap_pure) == (2, True)
+    assert permitting.any_of(admin, middling).crosscap_pure is False
+
+    # pure rules are checked once per request
+    del checked[:]
+    pure = permitting.costs(5, pure=True)(tracking('pure', True))
+    assert permitting.all_of(pure, permitting.any_of(cheap, pure), permitting.not_(permitting.not_(pure)))(u_user)
+    assert checked == ['pure', 'cheap']
+
+    # ... including ones that answer later
+    del checked[:]
+    pure_later = permitting.costs(5, pure=True)(tracking('pure_later', True, defer.succeed))
+    policy = permitting.all_of(pure_later, permitting.not_(cheap), permitting.any_of(cheap, pure_later))
+    assert _resolve(policy(u_user)) is True
+    assert checked == ['cheap', 'pure_later', 'cheap']
+
+    del checked[:]
+    later_false = tracking('later_false', False, defer.succeed)
+    assert _resolve(permitting.all_of(later_false, expensive)(u_user)) is False
+    assert checked == ['later_false']
+    assert _resolve(permitting.not_(later_false)(u_user)) is True
+
+    # costs() leaves the rule alone, so it works on bound methods
+    class Rules(object):
+        def is_mario(self, authuser):
+            return authuser.userID == 'mario'
+
+    rules = Rules()
+    costed = permitting.costs(2, pure=True)(rules.is_mario)
+    assert (costed.crosscap_cost, costed.__name__) == (2, 'is_mario')
+    assert not hasattr(rules.is_mario, 'crosscap_cost')
+    assert costed(u_user) is (u_user.userID == 'mario')
+
+
+def test_permits_combinators():
+    """
+    Do I order the rules given to permits() by cost?
+    """
+    checked = []
+    owner = permitting.costs(100)(lambda authuser: checked.append('owner'))
+
+    @permitting.permits(owner, permitting.role_in([ADMIN]))
+    def handler(request): # pragma: nocover
+        return Y
+
+    req = ctrequest([])
+    req.user = Mock(roles=[], userID='mario')
+    assert handler(req) == N
+    assert checked == []
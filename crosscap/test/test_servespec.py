@@ -0,0 +1,150 @@
+"""
+Tests of serving the OpenAPI spec from a running service
+"""
+import gzip
+import json
+
+from builtins import object
+
+from klein import Klein
+
+from pytest import inlineCallbacks, raises
+
+from twisted.internet import defer
+
+import yaml
+
+from mock import patch
+
+from crosscap import servespec, urltool, yamlhack
+from crosscap.test.conftest import TopApp
+from crosscap.testing import request
+
+
+class SpecApp(object):
+    app = Klein()
+    spec = servespec.ServedSpec('crosscap.test.test_servespec.SpecApp')
+
+    openAPISpec = spec.route(app, '/openapi')
+
+    @app.route('/hello')
+    def hello(self, request): # pragma: nocover
+        """
+        Say hello
+        """
+        return 'hello'
+
+
+def get(served, ext, *headers):
+    """
+    -> (request, Deferred of the response body) for a request of served's spec
+    """
+    req = request([], requestHeaders=headers)
+    return req, defer.maybeDeferred(served.render, req, ext)
+
+
+@inlineCallbacks
+def test_route():
+    """
+    Do I serve the spec as json and yaml from a Klein route?
+    """
+    inst = SpecApp()
+    req = request([])
+    body = yield defer.maybeDeferred(inst.app.execute_endpoint, 'openAPISpec', req, ext='yaml')
+    assert req.responseHeaders.getRawHeaders(b'content-type') == [b'application/yaml']
+    expected = yamlhack.dump(urltool.buildSpec(SpecApp)).encode('utf-8')
+    assert body == expected
+    assert b'/openapi.<any(json, yaml):ext>:' in body
+    assert b'summary: Say hello' in body
+
+    req = request([])
+    body = yield defer.maybeDeferred(inst.app.execute_endpoint, 'openAPISpec', req, ext='json')
+    assert req.responseHeaders.getRawHeaders(b'content-type') == [b'application/json']
+    assert json.loads(body.decode('utf-8')) == yaml.safe_load(expected)
+
+    # on a Klein app that doesn't belong to a class
+    served = servespec.ServedSpec(TopApp, 'hasqueryarg')
+    app = Klein()
+    served.route(app)
+    req = request([])
+    body = yield defer.maybeDeferred(app.execute_endpoint, 'openAPISpec', req, ext='json')
+    assert list(json.loads(body.decode('utf-8'))['paths']) == ['/sub/hasqueryarg']
+
+
+@inlineCallbacks
+def test_cached():
+    """
+    Do I build once, and serve gzip, ETags and 304s from memory?
+    """
+    served = servespec.ServedSpec(TopApp)
+    with patch.object(urltool, 'buildSpec', wraps=urltool.buildSpec) as m_buildSpec:
+        # concurrent requests share one build
+        (req1, d1), (req2, d2) = get(served, 'json'), get(served, 'yaml')
+        plain, yamlBody = yield defer.gatherResults([d1, d2])
+        etag = req1.responseHeaders.getRawHeaders(b'etag')[0]
+        assert req2.responseHeaders.getRawHeaders(b'etag')[0] != etag
+
+        req, d = get(served, 'json', ('accept-encoding', ['deflate, gzip;q=0.5']))
+        assert d.called
+        zipped = yield d
+        assert m_buildSpec.call_count == 1
+
+    assert gzip.GzipFile(fileobj=servespec.BytesIO(zipped)).read() == plain
+    assert req.responseHeaders.getRawHeaders(b'content-encoding') == [b'gzip']
+    assert req.responseHeaders.getRawHeaders(b'vary') == [b'Accept-Encoding']
+    gzipETag = req.responseHeaders.getRawHeaders(b'etag')[0]
+    assert gzipETag not in (etag, None)
+
+    req, d = get(served, 'json', ('accept-encoding', ['gzip;q=0']))
+    assert (yield d) == plain
+    req, d = get(served, 'json', ('accept-encoding', ['*;q=nonsense']))
+    assert (yield d) == plain
+
+    # revalidation
+    req, d = get(served, 'json', ('if-none-match', ['"other", W/' + etag.decode('ascii')]))
+    assert (yield d) == b''
+    assert req.code == 304
+    assert req.responseHeaders.getRawHeaders(b'content-type') is None
+    req, d = get(served, 'json', ('if-none-match', ['*']), ('accept-encoding', ['gzip']))
+    assert (yield d) == b''
+    assert req.code == 304
+    req, d = get(served, 'json', ('if-none-match', [gzipETag.decode('ascii')]))
+    assert (yield d) == plain
+    assert req.code == 200
+
+
+@inlineCallbacks
+def test_invalidate():
+    """
+    Do I serve the old spec until a rebuild is done, and rebuild again if invalidated during a build?
+    """
+    served = servespec.ServedSpec(TopApp)
+    _, d = get(served, 'yaml')
+    old = yield d
+
+    served.filt = 'hasqueryarg'
+    done = served.invalidate()
+    _, d = get(served, 'yaml')
+    assert (yield d) == old
+
+    served.filt = 'nothing matches this'
+    again = served.invalidate()
+    yield defer.gatherResults([done, again])
+    _, d = get(served, 'yaml')
+    assert b'/sub/' not in (yield d)
+
+
+@inlineCallbacks
+def test_buildFails():
+    """
+    Do I report a failed build to every request waiting for it, and try again next time?
+    """
+    served = servespec.ServedSpec('crosscap.test.test_servespec.Nothing')
+    (_, d1), (_, d2) = get(served, 'json'), get(served, 'yaml')
+    for d in d1, d2:
+        with raises(AttributeError):
+            yield d
+
+    served.rootCls = TopApp
+    _, d = get(served, 'json')
+    assert b'/sub/end' in (yield d)
@@ -2,13 +2,55 @@
 Tests of the tree decorators in kleinish
 """
 from inspect import cleandoc
+import gc
+import threading
 
-from pytest import inlineCallbacks
+from builtins import object
 
-from mock import Mock
+from klein import Klein
+from klein.interfaces import IKleinRequest
 
-from crosscap import tree
-from crosscap.test.conftest import TopApp
+from pytest import inlineCallbacks, mark
+
+from twisted.internet import defer
+from twisted.python import components
+from twisted.web import server
+from twisted.web.test.test_web import DummyChannel
+
+from mock import Mock, patch
+
+from crosscap import tree, urltool
+from crosscap.interface import ICurrentUser
+from crosscap.permitting import permits, role_in
+from crosscap.test.conftest import SubApp, TopApp
+
+
+class WarmTop(object):
+    app = Klein()
+
+    @app.route('/a/', branch=True)
+    @tree.enter('crosscap.test.test_tree.WarmMiddle')
+    def a(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+    @app.route('/b/', branch=True)
+    @permits()
+    @tree.enter('crosscap.test.test_tree.WarmMiddle')
+    def b(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+    @app.route('/c')
+    def c(self, request): # pragma: nocover
+        return 'c'
+
+
+class WarmMiddle(object):
+    app = Klein()
+
+    @app.route('/leaf/', branch=True)
+    @tree.enter('crosscap.test.conftest.SubApp')
+    def leaf(self, request, subKlein): # pragma: nocover
+        return subKlein
 
 
 @inlineCallbacks
@@ -39,7 +81,11 @@ def test_openapiDoc():
         ---
         a: b
         """
-    fn = tree.openAPIDoc(foo={'c': 'd'})(fn)
+    with patch('crosscap.yamlhack.dump') as m_dump:
+        fn = tree.openAPIDoc(foo={'c': 'd'})(fn)
+        assert fn._openAPIDoc == ({'foo': {'c': 'd'}},)
+    assert not m_dump.called
+
     expected = cleandoc('''
         This function has some stuff for sure
         ---
@@ -49,3 +95,364 @@ def test_openapiDoc():
           c: d
         ''') + '\n'
     assert fn.__doc__ == expected
+    assert fn.__name__ == 'fn'
+
+    # stacked, and on methods
+    class Documented(object):
+        @tree.openAPIDoc(tags=['z', 'a'])
+        @tree.openAPIDoc(foo={'c': 'd'})
+        def method(self, x):
+            return x
+
+    assert Documented().method(1) == 1
+    assert Documented.method._openAPIDoc == ({'foo': {'c': 'd'}}, {'tags': ['z', 'a']})
+    assert Documented.method.__doc__ == '---\nfoo:\n  c: d\n---\ntags:\n- z\n- a\n'
+
+    # under decorators that copy __doc__ when they are applied
+    with patch('crosscap.yamlhack.dump') as m_dump:
+        class Routed(object):
+            app = Klein()
+
+            @app.route('/sub/', branch=True)
+            @tree.enter('crosscap.test.conftest.SubApp')
+            @tree.openAPIDoc(foo={'c': 'd'})
+            def subTree(self, request, subKlein): # pragma: nocover
+                """
+                Enter the sub-app
+                """
+    assert not m_dump.called
+    assert Routed.subTree.__doc__ == 'Enter the sub-app\n---\nfoo:\n  c: d\n'
+    assert urltool.OpenAPIExtendedDocumentation.fromObject(Routed.subTree).yamlData == {'foo': {'c': 'd'}}
+
+    # above enter, in a flattened tree
+    class DocumentedTop(object):
+        app = Klein()
+
+        @app.route('/sub/', branch=True)
+        @tree.openAPIDoc(foo={'c': 'd'})
+        @tree.enter('crosscap.test.conftest.SubApp')
+        def subTree(self, request, subKlein):
+            return subKlein
+
+    assert DocumentedTop.subTree._openAPIDoc == ({'foo': {'c': 'd'}},)
+    resource = tree.flatten(DocumentedTop).resource()
+    assert _render(resource, b'/sub/end') == _render(DocumentedTop().app.resource(), b'/sub/end')
+
+
+def test_enterThreadSafe():
+    """
+    Do I build the subKlein only once, when the first requests arrive together?
+    """
+    constructed = []
+    barrier = threading.Barrier(2)
+
+    def slowSubApp():
+        barrier.wait()
+        constructed.append(1)
+        return SubApp()
+
+    class RacyTop(object):
+        app = Klein()
+
+        @app.route('/sub/', branch=True)
+        @tree.enter('crosscap.test.conftest.SubApp')
+        def subTree(self, request, subKlein):
+            return subKlein
+
+    results = []
+    def hit():
+        results.append(RacyTop().subTree(Mock()))
+
+    with patch.object(tree, 'namedAny', lambda qname: slowSubApp):
+        threads = [threading.Thread(target=hit) for n in range(2)]
+        for t in threads:
+            t.start()
+        # the first thread is inside the lock; let it out once the second is waiting there too
+        for t in threads:
+            t.join(0.1)
+        barrier.wait()
+        for t in threads:
+            t.join()
+
+    assert len(constructed) == 1
+    assert results[0] is results[1]
+
+
+@mark.parametrize("threads", [1, 3])
+def test_warmUp(threads):
+    """
+    Do I build every subKlein in the tree ahead of time?
+    """
+    handlers = [WarmTop.a, WarmTop.b, WarmMiddle.leaf]
+    for h in handlers:
+        h._subKlein = None
+
+    entered = tree.warmUp(WarmTop, threads=threads)
+    assert entered == [
+        'crosscap.test.test_tree.WarmMiddle',
+        'crosscap.test.test_tree.WarmMiddle',
+        'crosscap.test.conftest.SubApp',
+        ]
+    assert 'leaf' in WarmTop.a._subKlein._app.endpoints
+    assert 'end' in WarmMiddle.leaf._subKlein._app.endpoints
+    assert WarmTop.a._subKlein is not WarmTop.b._subKlein
+
+
+class FlatTop(object):
+    app = Klein()
+
+    @app.route('/')
+    def index(self, request):
+        return 'index'
+
+    @app.route('/org/<orgID>/', branch=True, methods=['GET'])
+    @tree.enter('crosscap.test.test_tree.FlatOrg')
+    def org(self, request, subKlein, orgID):
+        request.visited.append('org:' + orgID)
+        return subKlein
+
+    @app.route('/static/', branch=True)
+    def static(self, request):
+        return 'static ' + '/'.join(IKleinRequest(request).branch_segments)
+
+
+class FlatOrg(object):
+    app = Klein()
+
+    @app.route('/users/<userID>')
+    def user(self, request, userID):
+        request.visited.append('user:' + userID)
+        return ' '.join(request.visited)
+
+    @app.route('/admin/', branch=True)
+    @permits(role_in(['admin']))
+    @tree.enter('crosscap.test.test_tree.FlatAdmin')
+    def admin(self, request, subKlein):
+        request.visited.append('admin')
+        return subKlein
+
+    @app.route('/later/', branch=True)
+    @tree.enter('crosscap.test.test_tree.FlatAdmin')
+    def later(self, request, subKlein):
+        request.visited.append('later')
+        return defer.succeed(request.redirect or subKlein)
+
+
+class FlatAdmin(object):
+    app = Klein()
+
+    @app.route('/ping', methods=['POST'])
+    def ping(self, request): # pragma: nocover
+        return 'pong'
+
+    @app.route('/panel')
+    def panel(self, request):
+        request.visited.append('panel')
+        return ' '.join(request.visited)
+
+
+class FlatRequest(server.Request):
+    visited = None
+    roles = ()
+    redirect = None
+
+
+class FlatAuthUser(object):
+    def __init__(self, request):
+        self.request = request
+
+    def authenticate(self):
+        return True
+
+    def authenticated(self, user):
+        return user
+
+    def forbidden(self):
+        return 'forbidden'
+
+    @property
+    def roles(self):
+        return self.request.roles
+
+components.registerAdapter(FlatAuthUser, FlatRequest, ICurrentUser)
+
+
+def _render(resource, path, method=b'GET', **kw):
+    """
+    Render a request for path with resource
+
+    -> (response code, body)
+    """
+    req = FlatRequest(DummyChannel(), False)
+    transport = req.channel.transport
+    req.method = method
+    req.uri = req.path = path
+    req.prepath = []
+    req.postpath = path.split(b'/')[1:]
+    req.client, req.host = transport.getPeer(), transport.getHost()
+    req.gotLength(0)
+    req.requestHeaders.setRawHeaders(b'host', [b'localhost'])
+    req.visited = []
+    for k, v in kw.items():
+        setattr(req, k, v)
+    resource.render(req)
+    return req.code, transport.written.getvalue().split(b'\r\n\r\n', 1)[1]
+
+
+@mark.parametrize("path,method,kw,expect", [
+    [b'/', b'GET', {}, (200, b'index')],
+    [b'/org/o1/users/u1', b'GET', {}, (200, b'org:o1 user:u1')],
+    [b'/static/a/b.css', b'GET', {}, (200, b'static a/b.css')],
+
+    # branch handlers run in order, and can stop the request by not returning their subKlein
+    [b'/org/o1/admin/panel', b'GET', {'roles': ['admin']}, (200, b'org:o1 admin panel')],
+    [b'/org/o1/admin/panel', b'GET', {}, (200, b'forbidden')],
+    [b'/org/o1/later/panel', b'GET', {}, (200, b'org:o1 later panel')],
+    [b'/org/o1/later/panel', b'GET', {'redirect': 'elsewhere'}, (200, b'elsewhere')],
+
+    [b'/org/o1/nothing', b'GET', {}, (404, None)],
+
+    # the branch route to /org/ only allows GET (and HEAD)
+    [b'/org/o1/users/u1', b'POST', {}, (405, None)],
+    ])
+def test_flatten(path, method, kw, expect):
+    """
+    Do I route requests straight to the endpoint, the same way the tree would?
+    """
+    top = FlatTop()
+    for resource in [tree.flatten(FlatTop, top).resource(), top.app.resource()]:
+        code, body = _render(resource, path, method, **kw)
+        assert code == expect[0]
+        if expect[1] is not None:
+            assert body == expect[1]
+
+
+def test_flattenRules():
+    """
+    Do I make one rule for each endpoint, at its full path?
+    """
+    flat = tree.flatten(FlatTop)
+    rules = sorted((r.rule, sorted(r.methods or [])) for r in flat.url_map.iter_rules())
+    assert rules == [
+        ('/', []),
+        ('/org/<orgID>/admin/panel', ['GET', 'HEAD']),
+        ('/org/<orgID>/later/panel', ['GET', 'HEAD']),
+        ('/org/<orgID>/users/<userID>', ['GET', 'HEAD']),
+        ('/static/', []),
+        ('/static/<path:__rest__>', []),
+        ]
+
+    # POST /org/<orgID>/later/ping can't get through the branch route, which only allows GET
+    assert tree.flatten(FlatTop).url_map.bind('localhost').test('/org/o1/later/ping', 'POST') is False
+
+
+def test_routeCache():
+    """
+    Do I remember where URLs go, and forget when the routes change?
+    """
+    # defined here, as this test adds a route to CachedSub
+    class CachedTop(object):
+        app = Klein()
+
+        @app.route('/n/<int:n>', methods=['GET'])
+        def number(self, request, n):
+            return 'number %d' % n
+
+        @app.route('/sub/', branch=True)
+        @tree.enter('crosscap.test.test_tree.CachedSub')
+        def sub(self, request, subKlein):
+            return subKlein
+
+    class CachedSub(object):
+        app = Klein()
+
+        @app.route('/a')
+        def a(self, request):
+            return 'a'
+
+    routes = tree.RouteCache(maxsize=2)
+    with patch('crosscap.test.test_tree.CachedSub', CachedSub, create=True):
+        resource = tree.flatten(CachedTop, cache=routes).resource()
+
+    assert _render(resource, b'/n/1') == (200, b'number 1')
+    assert _render(resource, b'/n/1') == (200, b'number 1')
+    assert routes.stats() == {'hits': 1, 'misses': 1, 'ratio': 0.5, 'size': 1, 'maxsize': 2}
+
+    # the method and the converted arguments are part of the answer
+    assert _render(resource, b'/n/2') == (200, b'number 2')
+    assert _render(resource, b'/n/1', b'POST')[0] == 405
+    assert _render(resource, b'/n/x')[0] == 404
+    assert _render(resource, b'/n/1', b'POST')[0] == 405
+    assert (routes.hits, routes.misses, len(routes)) == (1, 5, 2)
+
+    # least recently used URLs are forgotten
+    assert _render(resource, b'/sub/a') == (200, b'a')
+    assert _render(resource, b'/n/1') == (200, b'number 1')
+    assert (routes.hits, routes.misses, len(routes)) == (1, 7, 2)
+
+    # a route added to an app in the tree is found, and the cache is cleared
+    @CachedSub.app.route('/b')
+    def b(self, request):
+        return 'b'
+
+    assert _render(resource, b'/sub/b') == (200, b'b')
+    assert len(routes) == 1
+
+    # werkzeug's other ways of matching skip the cache
+    flat = tree.flatten(CachedTop, cache=routes)
+    adapter = flat.url_map.bind('localhost', path_info='/n/3')
+    assert adapter.match() == ('/n/<int:n> CachedTop.number', {'n': 3})
+    assert adapter.match('/n/4') == ('/n/<int:n> CachedTop.number', {'n': 4})
+    assert adapter.build('/n/<int:n> CachedTop.number', {'n': 5}) == '/n/5'
+    assert routes.stats()['misses'] == 9
+
+    nocache = tree.RouteCache(maxsize=0)
+    flat = tree.flatten(CachedTop, cache=nocache)
+    assert flat.url_map.bind('localhost', path_info='/n/3').match() == ('/n/<int:n> CachedTop.number', {'n': 3})
+    assert (len(nocache), nocache.stats()['ratio']) == (0, 0.0)
+
+
+def test_flattenWatch():
+    """
+    Do I find enter() under decorators that don't copy its attributes, and recompile only the
+    flat apps of the tree that changed?
+    """
+    def opaque(fn):
+        def wrapper(self, request, *a, **kw):
+            return fn(self, request, *a, **kw)
+        wrapper.__name__, wrapper.__wrapped__ = fn.__name__, fn
+        return wrapper
+
+    class WatchedSub(object):
+        app = Klein()
+
+        @app.route('/a')
+        def a(self, request):
+            return 'a'
+
+    class WatchedTop(object):
+        app = Klein()
+
+        @app.route('/sub/', branch=True)
+        @opaque
+        @tree.enter('crosscap.test.conftest.SubApp')
+        def sub(self, request, subKlein):
+            return subKlein
+
+    with patch('crosscap.test.conftest.SubApp', WatchedSub):
+        flat = tree.flatten(WatchedTop)
+        gone = tree.flatten(WatchedTop)
+    other = tree.flatten(FlatTop)
+    resource = flat.resource()
+    assert _render(resource, b'/sub/a') == (200, b'a')
+    del gone
+    gc.collect()
+
+    @WatchedSub.app.route('/b')
+    def b(self, request):
+        return 'b'
+
+    assert _render(resource, b'/sub/b') == (200, b'b')
+    assert (flat._routesAdded, other._routesAdded) == (1, 0)
+    assert len(WatchedSub.app.url_map.add._crosscapWatchers) == 1
+
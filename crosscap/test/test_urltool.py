@@ -1,17 +1,27 @@
 """
 Tests of the urltool command-line program
 """
+from collections import OrderedDict
 from inspect import cleandoc
+import gzip
+import json
+import pickle
+import re
 
 from click.testing import CliRunner
 
-from pytest import fixture
+from klein import Klein
+
+from mock import patch
+
+from pytest import fixture, mark, raises
 
 import yaml
 
 from werkzeug.routing import Rule
 
-from crosscap import urltool
+from crosscap import enter, openAPIDoc, openapi, urltool, yamlhack
+from crosscap.doccache import DocCache
 from crosscap.test.conftest import TopApp, SubApp
 
 
@@ -40,6 +50,17 @@ def test_dumpRule():
     assert utr2 == expect2
 
 
+def test_buildSpec():
+    """
+    Do I build the same spec as the urltool command, as an OpenAPI object?
+    """
+    spec = urltool.buildSpec(TopApp, 'hasqueryarg')
+    assert isinstance(spec, openapi.OpenAPI)
+    assert list(spec.paths) == ['/sub/hasqueryarg']
+    assert list(urltool.buildSpec(TopApp, 'hasqueryarg', reverse=True).paths) == ['/sub/end']
+    assert list(urltool.buildSpec(TopApp).paths) == ['/sub/end', '/sub/hasqueryarg']
+
+
 @fixture
 def runner():
     return CliRunner()
@@ -174,9 +195,283 @@ def test_postOptions(runner):
         """)
 
 
+def test_formatJSON(runner):
+    """
+    Do I write the same spec as json?
+    """
+    res = runner.invoke(urltool.urltool, ['crosscap.test.conftest.TopApp', '--format', 'json'])
+    asYAML = runner.invoke(urltool.urltool, ['crosscap.test.conftest.TopApp', '--format', 'yaml'])
+    assert res.exit_code == asYAML.exit_code == 0
+    assert json.loads(res.output) == yaml.safe_load(asYAML.output)
+    assert res.output.startswith('{\n  "openapi": "3.0.0",\n')
+
+
+class SharedApp(object):
+    app = Klein()
+
+    @app.route('/shared/b', methods=['GET', 'PUT'])
+    @app.route('/shared/a', methods=['GET', 'PUT'])
+    @openAPIDoc(tags=['shared'], parameters=[openapi.queryParameter('color')])
+    def shared(self, request): # pragma: nocover
+        """
+        The operations of this share their tags and parameters, so its yaml has anchors
+        """
+
+
+@mark.parametrize('qname,filt', [
+    ('crosscap.test.conftest.TopApp', None),
+    ('crosscap.test.conftest.TopApp', 'nothing matches this'),
+    ('crosscap.test.test_urltool.SharedApp', None),
+    ])
+@mark.parametrize('fmt', ['yaml', 'json'])
+def test_stream(runner, tmpdir, qname, filt, fmt):
+    """
+    Do I write the same thing a path at a time as when I build the whole spec?
+    """
+    args = [qname] + ([filt] if filt else []) + ['--format', fmt]
+    expected = runner.invoke(urltool.urltool, args).output
+    output = str(tmpdir / 'spec')
+    res = runner.invoke(urltool.urltool, args + ['--stream', '--output', output])
+    assert res.exit_code == 0
+    with open(output) as f:
+        assert f.read() == expected
+    assert ('*id001' in expected) == (fmt == 'yaml' and qname.endswith('SharedApp'))
+
+
 def test_yamlMultilineString():
     """
     Do I properly represent strings using multiline syntax
     """
     obj = {'thing': 'a\nb'}
-    assert yaml.dump(obj, default_flow_style=False) == 'thing: |-\n  a\n  b\n'
+    assert yamlhack.dump(obj) == 'thing: |-\n  a\n  b\n'
+
+
+def test_scopedYAML():
+    """
+    Do I keep my representers to crosscap's own Dumper, and read docstrings safely?
+    """
+    obj = OrderedDict([('z', ('a', 'b')), ('a', 'c\nd')])
+    assert yamlhack.dump(obj) == 'z:\n- a\n- b\na: |-\n  c\n  d\n'
+    assert 'OrderedDict' in yaml.dump(obj)
+    with raises(yaml.representer.RepresenterError):
+        yaml.safe_dump(openapi.OpenAPI())
+
+    def danger(): # pragma: nocover
+        """
+        Danger
+        ---
+        x: !!python/name:os.system
+        """
+    with raises(yaml.constructor.ConstructorError):
+        urltool.OpenAPIExtendedDocumentation.fromObject(danger)
+
+
+@mark.skipif(not getattr(yaml, '__with_libyaml__', False), reason="PyYAML was built without libyaml")
+def test_libyaml(): # pragma: nocover (only with libyaml)
+    """
+    Does the libyaml Loader read the same data as the pure-Python one?
+    """
+    assert issubclass(yamlhack.Loader, yaml.CSafeLoader)
+    text = cleandoc(u'''
+        a: &shared [x, y]
+        b: *shared
+        200: {when: 2020-01-02, long: "caf\\u00e9\\nline"}
+        ---
+        c: |-
+          literal
+          text
+        ''')
+    assert list(yamlhack.load_all(text)) == list(yaml.load_all(text, Loader=yamlhack.PyLoader))
+
+    for rootCls in TopApp, SharedApp:
+        with patch.object(yamlhack, 'Loader', yamlhack.PyLoader):
+            expected = urltool.buildSpec(rootCls)
+        assert urltool.buildSpec(rootCls) == expected
+
+
+def test_docCache(runner, tmpdir):
+    """
+    Do I skip parsing docstrings I have parsed before, and produce the same spec?
+    """
+    path = str(tmpdir / 'doc-cache')
+    args = ['crosscap.test.test_urltool.SharedApp', '--doc-cache', path]
+    expected = runner.invoke(urltool.urltool, ['crosscap.test.test_urltool.SharedApp']).output
+
+    assert runner.invoke(urltool.urltool, args).output == expected
+    cache = DocCache.load(path)
+    assert len(cache.entries) == 1
+    with patch.object(yamlhack, 'load_all') as m_load_all:
+        assert runner.invoke(urltool.urltool, args).output == expected
+        assert runner.invoke(urltool.urltool, args + ['--stream']).output == expected
+    assert not m_load_all.called
+
+    # docstrings with no yaml, no docstring, and openAPIDoc with no docstring
+    cache = DocCache.load(path)
+    expected = urltool.buildSpec(TopApp)
+    assert urltool.buildSpec(TopApp, docCache=cache) == expected
+    assert (cache.hits, cache.misses) == (0, 3)
+    cache.save()
+    cache.save()
+    cache = DocCache.load(path)
+    spec = urltool.buildSpec(TopApp, docCache=cache)
+    assert (cache.hits, cache.misses) == (3, 0)
+    assert yamlhack.dump(spec) == yamlhack.dump(expected)
+    assert spec.paths['/sub/end']._operations['post'].description == expected.paths['/sub/end']._operations['post'].description
+
+    # another version of crosscap, or a damaged file
+    old = DocCache(path, version='0.0.0')
+    old.put('Old', True, 'Old', 'Old', None)
+    old.save()
+    assert DocCache.load(path).entries == {}
+    with open(path, 'wb') as f:
+        f.write(b'damaged')
+    assert DocCache.load(path).entries == {}
+
+
+def test_docCacheTypes(tmpdir):
+    """
+    Do I save every type yaml's safe loader produces as JSON, and refuse anything else?
+    """
+    path = str(tmpdir / 'doc-cache')
+    yamlData = yamlhack.load_all(cleandoc('''
+        responses:
+          200: {description: ok}
+          null: [1.5, .inf, true, ~]
+        x-set: !!set {a, b}
+        x-binary: !!binary aGVsbG8=
+        x-date: 2020-01-02
+        x-when: 2020-01-02 03:04:05.5 +01:00
+        x-naive: 2020-01-02 03:04:05
+        '''))
+    yamlData = list(yamlData)[0]
+    cache = DocCache(path)
+    cache.put('Doc', True, u'Doc \u2603', b'bytes', yamlData)
+    cache.save()
+    with gzip.open(path, 'rb') as f:
+        assert json.loads(f.read().decode('utf-8'))['version'] == cache.version
+
+    loaded = DocCache.load(path)
+    assert loaded.entries == cache.entries
+    assert loaded.get('Doc', True)[2] == yamlData
+
+    # tags I don't know, and pickles, are damaged files
+    with gzip.open(path, 'wb') as f:
+        f.write(json.dumps({'version': cache.version, 'entries': [
+            [True, '00', 'Doc', 'Doc', {'object': 'os.system'}]]}).encode('utf-8'))
+    assert DocCache.load(path).entries == {}
+    with gzip.open(path, 'wb') as f:
+        pickle.dump((cache.version, cache.entries), f)
+    assert DocCache.load(path).entries == {}
+
+
+@mark.parametrize('pattern,prefix', [
+    ('^/api/billing', '/api/billing'),
+    ('^/api/bill?ing', '/api/bil'),
+    ('^/api/bil*ing', '/api/bi'),
+    ('^/api/bil{2}ing', '/api/bi'),
+    ('^/api/bil+ing', '/api/bil'),
+    ('^/a\\.b\\d', '/a.b'),
+    ('^/x[yz]', '/x'),
+    ('^(?i)/api', ''),
+    ('^/end\\', '/end'),
+    ('/api', None),
+    ('^/a|^/b', None),
+    ])
+def test_literalPrefix(pattern, prefix):
+    """
+    Do I find the literal text that all matches of an anchored pattern start with?
+    """
+    assert urltool.literalPrefix(pattern) == prefix
+
+
+class PrunedApp(object):
+    app = Klein()
+
+    @app.route('/sub/', branch=True)
+    @enter('crosscap.test.conftest.SubApp')
+    def sub(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+    @app.route('/elsewhere/', branch=True)
+    @enter('crosscap.test.test_urltool.DoesNotExist')
+    def elsewhere(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+
+def test_pruned():
+    """
+    Do I leave out sub-apps that can't match an anchored filter, without importing them?
+    """
+    full = urltool.buildSpec(TopApp)
+    for filt in '^/sub/end', '^/su', '^/sub/hasqueryarg$':
+        expected = urltool.buildSpec(TopApp, filt)
+        assert urltool.buildSpec(PrunedApp, filt) == expected
+    assert list(urltool.buildSpec(PrunedApp, '^/su').paths) == list(full.paths)
+
+    for filt, reverse in ('sub', False), ('^/sub', True), (None, False):
+        with raises(AttributeError):
+            urltool.buildSpec(PrunedApp, filt, reverse)
+
+
+class ParallelApp(object):
+    app = Klein()
+
+    @app.route('/one/', branch=True)
+    @enter('crosscap.test.conftest.TopApp')
+    def one(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+    @app.route('/two/', branch=True)
+    @enter('crosscap.test.test_urltool.SharedApp')
+    def two(self, request, subKlein): # pragma: nocover
+        return subKlein
+
+    @app.route('/two/shared/a', methods=['POST'])
+    def postShared(self, request): # pragma: nocover
+        """
+        The same path as one in a sub-app
+        """
+
+
+@mark.parametrize('filt,reverse', [(None, False), ('^/one/', False), ('^/one/', True), ('^/nothing', False)])
+@mark.parametrize('jobs', [2, 3])
+def test_jobs(runner, tmpdir, filt, reverse, jobs):
+    """
+    Do I produce the same spec with several processes as with one?
+    """
+    args = ['crosscap.test.test_urltool.ParallelApp'] + ([filt] if filt else []) + (['--reverse'] if reverse else [])
+    for fmt in 'yaml', 'json':
+        expected = runner.invoke(urltool.urltool, args + ['--format', fmt]).output
+        res = runner.invoke(urltool.urltool, args + ['--format', fmt, '--jobs', str(jobs)])
+        assert res.exit_code == 0
+        assert res.output == expected
+    if not filt:
+        assert expected.count('operationId') == 9
+
+    path = str(tmpdir / 'doc-cache')
+    res = runner.invoke(urltool.urltool, args + ['--jobs', str(jobs), '--stream', '--doc-cache', path])
+    assert res.output == runner.invoke(urltool.urltool, args).output
+    cache = DocCache.load(path)
+    with patch.object(yamlhack, 'load_all') as m_load_all:
+        urltool.buildSpec(ParallelApp, filt, reverse, docCache=cache)
+    assert cache.misses == 0
+    assert not m_load_all.called
+
+
+def test_subtreePaths():
+    """
+    Do my worker processes document a sub-app, and send back what they added to the DocCache?
+    """
+    task = ('crosscap.test.conftest.SubApp', '/sub/', re.compile('.*'), False, None)
+    expected = list(urltool.buildSpec(TopApp).paths.items())
+    try:
+        urltool._initWorker(DocCache(None))
+        paths, added = urltool._subtreePaths(task)
+        assert paths == expected
+        assert len(added) == 3
+        assert urltool._subtreePaths(task) == (expected, {})
+
+        urltool._initWorker(None)
+        assert urltool._subtreePaths(task) == (expected, {})
+    finally:
+        urltool._initWorker(None)
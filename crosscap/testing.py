@@ -4,8 +4,11 @@ Tools for testing applications that use crosscap
 from builtins import object
 
 from twisted.internet import defer
+from twisted.web.iweb import IRequest
 from twisted.web.test.requesthelper import DummyRequest as _DummyRequest
 
+from zope.interface import implementer
+
 import attr
 
 
@@ -15,9 +18,13 @@ DEFAULT_HEADERS = (
     )
 
 
+@implementer(IRequest)
 class DummyRequest(_DummyRequest):
     """
     Patch a weird bug in twisted's _DummyRequest - it doesn't set .code, it sets .responseCode
+
+    Also declare IRequest, as the real request does, so permits() remembers the authenticated user
+    on it.
     """
     def setResponseCode(self, code, message=None):
         _DummyRequest.setResponseCode(self, code, message)
@@ -23,47 +23,466 @@ class TheSecond(object):
 
 In the above system, a request for GET '/api/anything' will be handled by
 TheSecond.anything()
+
+TheSecond is imported and instantiated on the first request to /api/. To pay that cost at startup
+instead, call warmUp(TheFirst) before serving.
+
+Each request passes through one Klein app per level of the tree. To route every request straight
+to its endpoint with one URL match instead, serve flatten(TheFirst).resource(). The flat app can
+also remember where the most requested URLs go, with a RouteCache:
+
+    routes = RouteCache(maxsize=4096)
+    resource = flatten(TheFirst, cache=routes).resource()
 """
+from collections import OrderedDict, UserString
 import functools
 from inspect import cleandoc
+import re
+import threading
+import weakref
+
+from builtins import object
 
-import yaml
+import attr
 
+from klein import Klein
+
+from twisted.internet import defer
 from twisted.python.reflect import namedAny
 
+from werkzeug.routing import Map
+
+
+DEFAULT_ROUTE_CACHE_SIZE = 4096
+
 
 def enter(clsQname):
     """
     Delegate a rule to another class which instantiates a Klein app
 
-    This also memoizes the resource instance on the handler function itself
+    This also memoizes the resource instance on the handler function itself. It is built at most
+    once, even when the first requests to the branch arrive on several threads at once. The
+    handler's _subKleinBuild() builds it if necessary, and returns (instance of the class, resource).
     """
     def wrapper(routeHandler):
+        lock = threading.Lock()
+
+        def build():
+            if inner._subKlein is None:
+                with lock:
+                    if inner._subKlein is None:
+                        cls = namedAny(clsQname)
+                        inner._subKleinInstance = cls()
+                        inner._subKlein = inner._subKleinInstance.app.resource()
+            return inner._subKleinInstance, inner._subKlein
+
         @functools.wraps(routeHandler)
         def inner(self, request, *a, **kw):
-            if getattr(inner, '_subKlein', None) is None:
-                cls = namedAny(clsQname)
-                inner._subKlein = cls().app.resource()
-            return routeHandler(self, request, inner._subKlein, *a, **kw)
+            subKlein = inner._subKlein
+            if subKlein is None:
+                subKlein = build()[1]
+            return routeHandler(self, request, subKlein, *a, **kw)
+        inner._subKlein = None
         inner._subKleinQname = clsQname
+        inner._subKleinBuild = build
         return inner
     return wrapper
 
 
+def _entered(handler):
+    """
+    -> handler, or the function it wraps, with the attributes of enter() (_subKleinBuild and
+    _subKleinQname); or None if it wasn't decorated with enter()
+
+    This looks through the __wrapped__ of decorators applied after enter() that don't copy those
+    attributes.
+    """
+    while handler is not None:
+        if hasattr(handler, '_subKleinBuild'):
+            return handler
+        handler = getattr(handler, '__wrapped__', None)
+    return None
+
+
+def _enteredHandlers(cls):
+    """
+    -> the route handlers of cls that were decorated with enter()
+    """
+    found = OrderedDict()
+    for rule in cls.app.url_map.iter_rules():
+        name = rule.endpoint
+        if name.endswith('_branch'):
+            name = name[:-7]
+        meth = _entered(getattr(cls, name, None))
+        if meth is not None:
+            found[name] = meth
+    return list(found.values())
+
+
+def warmUp(rootCls, threads=1):
+    """
+    Build the sub-app resource of every enter() in the tree under rootCls, now
+
+    Otherwise each one is imported and built on the first request to its branch.
+
+    - threads: build up to this many sub-apps at once
+
+    -> list of the class names that were entered, in the order they were found
+    """
+    pool = None
+    if threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+
+    entered = []
+    seen = set([rootCls])
+    pending = [rootCls]
+    try:
+        while pending:
+            handlers = [h for cls in pending for h in _enteredHandlers(cls)]
+            builds = [h._subKleinBuild for h in handlers]
+            if pool is not None:
+                pool.map(_call, builds)
+            else:
+                list(map(_call, builds))
+
+            # descend into the classes just entered
+            pending = []
+            for handler in handlers:
+                entered.append(handler._subKleinQname)
+                cls = namedAny(handler._subKleinQname)
+                if cls not in seen:
+                    seen.add(cls)
+                    pending.append(cls)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return entered
+
+
+def _call(fn):
+    return fn()
+
+
+@attr.s(frozen=True)
+class _Hook(object):
+    """
+    A branch handler to run before an endpoint in a flattened tree
+    """
+    instance = attr.ib()
+    execute = attr.ib()
+    arguments = attr.ib()
+    subKlein = attr.ib()
+
+
+class RouteCache(object):
+    """
+    A bounded LRU of URLs that have been matched, and the rule and arguments they matched
+
+    Entries are keyed by the request method, scheme, host and path, so method restrictions, host
+    rules and converters give the same answers as matching the URL again. URLs that don't match
+    (404, 405 and redirects) are not remembered.
+
+    - maxsize: the number of URLs to remember
+    """
+    def __init__(self, maxsize=DEFAULT_ROUTE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        -> dict of counters, for sizing the cache
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': float(self.hits) / total if total else 0.0,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
+
+    def clear(self):
+        """
+        Forget every URL, e.g. after routes change
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def match(self, adapter):
+        """
+        -> (rule, arguments) for the URL bound to adapter, a werkzeug MapAdapter
+        """
+        key = (adapter.default_method, adapter.url_scheme, adapter.server_name, adapter.subdomain,
+                adapter.script_name, adapter.path_info)
+        with self._lock:
+            found = self._entries.pop(key, None)
+            if found is not None:
+                self._entries[key] = found
+                self.hits += 1
+                return found[0], dict(found[1])
+            self.misses += 1
+
+        rule, arguments = adapter.match(return_rule=True)
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[key] = (rule, dict(arguments))
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return rule, arguments
+
+
+class _CachedMapAdapter(object):
+    """
+    A werkzeug MapAdapter that asks a RouteCache before matching
+    """
+    def __init__(self, adapter, cache):
+        self._adapter = adapter
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._adapter, name)
+
+    def match(self, path_info=None, method=None, return_rule=False, query_args=None, websocket=None):
+        if path_info is not None or method is not None or query_args is not None or websocket is not None:
+            return self._adapter.match(path_info, method, return_rule, query_args, websocket)
+        rule, arguments = self._cache.match(self._adapter)
+        return (rule if return_rule else rule.endpoint), arguments
+
+
+class _CachedMap(Map):
+    """
+    A werkzeug Map whose URL matches are remembered in a RouteCache
+    """
+    def __init__(self, cache, *a, **kw):
+        Map.__init__(self, *a, **kw)
+        self.routeCache = cache
+
+    def bind(self, *a, **kw):
+        return _CachedMapAdapter(Map.bind(self, *a, **kw), self.routeCache)
+
+
+class _FlatKlein(Klein):
+    """
+    A Klein app compiled from a tree of them, which is compiled again when routes are added to the tree
+    """
+    def __init__(self, rootCls, instance, cache):
+        Klein.__init__(self)
+        self._root = (rootCls, instance)
+        self._cache = cache
+        self._compileLock = threading.Lock()
+        # how many routes have been added to the apps of the tree; counted by _watch
+        self._routesAdded = 0
+        self._compile()
+
+    def _compile(self):
+        self._compiled = self._routesAdded
+        self._url_map = Map() if self._cache is None else _CachedMap(self._cache)
+        self._endpoints = {}
+        rootCls, instance = self._root
+        _flattenClass(self, rootCls, instance, '', (), None)
+        if self._cache is not None:
+            self._cache.clear()
+
+    @property
+    def url_map(self):
+        if self._compiled != self._routesAdded:
+            with self._compileLock:
+                if self._compiled != self._routesAdded:
+                    self._compile()
+        return self._url_map
+
+
+def _watch(urlMap, flat):
+    """
+    Count the routes added to urlMap in flat._routesAdded
+
+    This replaces the add method of urlMap (the instance, not the Map class) the first time, with
+    one that also counts for every flat app watching urlMap. The flat apps are only weakly referenced.
+    """
+    watchers = getattr(urlMap.add, '_crosscapWatchers', None)
+    if watchers is None:
+        add = urlMap.add
+        watchers = []
+
+        def watchedAdd(rulefactory):
+            add(rulefactory)
+            for ref in list(watchers):
+                watcher = ref()
+                if watcher is None:
+                    watchers.remove(ref)
+                else:
+                    watcher._routesAdded += 1
+
+        watchedAdd._crosscapWatchers = watchers
+        urlMap.add = watchedAdd
+
+    if not any(ref() is flat for ref in watchers):
+        watchers.append(weakref.ref(flat))
+
+
+def flatten(rootCls, instance=None, cache=None):
+    """
+    Compile the tree under rootCls into a single Klein app, which routes each request straight to
+    its endpoint with one URL match
+
+    The branch handlers decorated with enter() still run, outermost first, before the endpoint.
+    When a branch handler returns something other than its subKlein (e.g. permits() forbidding
+    the request), that is the response, and the endpoint is not called.
+
+    Unlike the tree, the flat app doesn't use the error handlers of the apps in it, and
+    request.prepath and request.postpath are not updated between one branch handler and the
+    next. Routes that no request method can reach through the branch routes are left out, so they
+    are 404 Not Found rather than 405 Method Not Allowed.
+
+    When routes are added to any app in the tree, the flat app is compiled again before the next
+    request, and the cache is cleared.
+
+    - instance: the instance of rootCls to handle requests with; a new one by default
+    - cache: a RouteCache to remember where URLs go, instead of matching them every time
+
+    -> a Klein app
+    """
+    if instance is None:
+        instance = rootCls()
+    return _FlatKlein(rootCls, instance, cache)
+
+
+def _allowed(methods, rule):
+    """
+    -> the methods allowed by both methods and rule (None allows all)
+    """
+    if rule.methods is None:
+        return methods
+    if methods is None:
+        return frozenset(rule.methods)
+    return methods & rule.methods
+
+
+def _flattenClass(flat, cls, instance, prefix, hooks, methods):
+    """
+    Add the routes of cls, and of the classes it enters, to the flat app
+
+    - methods: the request methods allowed by the branch routes leading to cls, or None for any
+    """
+    _watch(cls.app.url_map, flat)
+    endpoints = cls.app.endpoints
+    for rule in cls.app.url_map.iter_rules():
+        name = rule.endpoint
+        if name.endswith('_branch') and name[:-7] in endpoints:
+            # the other half of a branch route
+            continue
+
+        path = re.sub('/{2,}', '/', prefix + rule.rule)
+        meth = _entered(getattr(cls, name, None))
+        if meth is not None:
+            subInstance, subKlein = meth._subKleinBuild()
+            hook = _Hook(instance, endpoints[name], tuple(rule.arguments), subKlein)
+            _flattenClass(flat, subInstance.__class__, subInstance, path, hooks + (hook,), _allowed(methods, rule))
+            continue
+
+        kwargs = dict(rule.get_empty_kwargs())
+        kwargs['endpoint'] = '{} {}.{}'.format(path, cls.__name__, name)
+        kwargs['methods'] = _allowed(methods, rule)
+        if kwargs['methods'] is not None and not kwargs['methods']:
+            # no request could get here through the tree
+            continue
+        flat.route(path, branch=name + '_branch' in endpoints, **kwargs)(
+            _dispatcher(hooks, instance, endpoints[name], tuple(rule.arguments))
+        )
+
+
+def _dispatcher(hooks, instance, execute, arguments):
+    """
+    -> a flat app endpoint which runs the hooks, then calls execute
+    """
+    leaf = (instance, execute, arguments)
+
+    def dispatch(request, **kw):
+        return _runHooks(hooks, 0, request, kw, leaf)
+
+    return dispatch
+
+
+def _runHooks(hooks, start, request, kw, leaf):
+    """
+    Run hooks[start:] in order, then the endpoint in leaf, stopping early if a hook doesn't return its subKlein
+    """
+    for n in range(start, len(hooks)):
+        hook = hooks[n]
+        result = hook.execute(hook.instance, request, **_pick(kw, hook.arguments))
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(_resumeHooks, hook.subKlein, hooks, n + 1, request, kw, leaf)
+        if result is not hook.subKlein:
+            return result
+
+    instance, execute, arguments = leaf
+    return execute(instance, request, **_pick(kw, arguments))
+
+
+def _resumeHooks(result, subKlein, hooks, start, request, kw, leaf):
+    """
+    Continue _runHooks with the result of a hook that returned a Deferred
+    """
+    if result is not subKlein:
+        return result
+    return _runHooks(hooks, start, request, kw, leaf)
+
+
+def _pick(kw, names):
+    """
+    -> the items of kw named in names
+    """
+    return dict((name, kw[name]) for name in names if name in kw)
+
+
+class _OpenAPIDocstring(UserString):
+    """
+    The docstring of a handler decorated with openAPIDoc, with the metadata appended as yaml
+
+    The yaml is only rendered the first time the string is used, so decorating a handler (or
+    copying its __doc__, as app.route and enter do) costs nothing at import.
+    """
+    def __init__(self, seq='', routeHandler=None):
+        UserString.__init__(self, seq)
+        self._routeHandler = routeHandler
+
+    @property
+    def data(self):
+        if self._routeHandler is not None:
+            from crosscap import yamlhack
+
+            doc = self._routeHandler._openAPIDocBase
+            for metadata in self._routeHandler._openAPIDoc:
+                doc = cleandoc(doc or '') + '\n---\n' + yamlhack.dump(metadata)
+            self._data, self._routeHandler = doc, None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+
 def openAPIDoc(**kwargs):
     """
-    Update a function's docstring to include the OpenAPI Yaml generated by running the openAPIGraph object
+    Update a function's docstring to include the OpenAPI Yaml generated from kwargs
+
+    The metadata is also kept as it was given, in decorator order, in the function's _openAPIDoc,
+    for urltool to read; and the yaml is only rendered when the docstring is first used.
     """
-    s = yaml.dump(kwargs, default_flow_style=False)
     def deco(routeHandler):
-        # Wrap routeHandler, retaining name and __doc__, then edit __doc__.
-
-        # The only reason we need to do this is so we can be certain
-        # that __doc__ will be modifiable. partial() objects have
-        # a modifiable __doc__, but native function objects do not.
-        ret = functools.wraps(routeHandler)(routeHandler)
-        if not ret.__doc__:
-            ret.__doc__ = ''
-        ret.__doc__ = cleandoc(ret.__doc__) + '\n---\n' + s
-        return ret
+        if not hasattr(routeHandler, '_openAPIDoc'):
+            routeHandler._openAPIDocBase = routeHandler.__doc__
+            routeHandler._openAPIDoc = ()
+        routeHandler._openAPIDoc = routeHandler._openAPIDoc + (kwargs,)
+        routeHandler.__doc__ = _OpenAPIDocstring(routeHandler=routeHandler)
+        return routeHandler
     return deco
@@ -5,45 +5,349 @@ This assumes using crosscap.tree.enter() decorator
 """
 from __future__ import print_function
 
+import copy
+from io import StringIO
+import itertools
+import multiprocessing
+import operator
 import re
 
 from builtins import object
 
 import click
 
-import yaml
-
 import attr
 
 from twisted.python.reflect import namedAny
 
-from crosscap import openapi
+from crosscap import openapi, yamlhack
 from crosscap.doc import Documentation
+from crosscap.doccache import DocCache
+from crosscap.yamlhack import literal_unicode_representer
+
+
+(literal_unicode_representer,) # for pyflakes; literal_unicode_representer used to live here
+
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
 
 
-def _iterClass(cls, prefix=''):
+def literalPrefix(pattern):
+    """
+    -> the literal text that all matches of pattern, a regular expression anchored with ^, start with
+
+    -> None if pattern is not anchored, or has alternatives that would make this hard to work out
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return None
+
+    literal = []
+    n = 1
+    while n < len(pattern):
+        char, step = pattern[n], 1
+        if char == '\\':
+            char, step = pattern[n + 1:n + 2], 2
+            if not char or char.isalnum():
+                # a class like \d or a backreference, not a literal character
+                break
+        elif char in _REGEX_SPECIAL:
+            break
+
+        following = pattern[n + step:n + step + 1]
+        if following and following in '*?{':
+            # the character may not be there at all
+            break
+        literal.append(char)
+        if following == '+':
+            break
+        n += step
+
+    return ''.join(literal)
+
+
+def _mayContain(rulePath, pathPrefix):
+    """
+    Can urls below rulePath start with pathPrefix?
+    """
+    return not pathPrefix or rulePath.startswith(pathPrefix) or pathPrefix.startswith(rulePath)
+
+
+def _iterClass(cls, prefix='', document=True, pathPrefix=None, descend=True):
     """
     Descend a Klein()'s url_map, and generate ConvertedRule() for each one
+
+    With document=False, docstrings are not read, and the ConvertedRules have no doco
+
+    With pathPrefix, don't descend into sub-apps whose urls can't start with pathPrefix, so they
+    aren't even imported. With descend=False, don't descend into any.
     """
     iterableRules = [(prefix, cls, cls.app.url_map.iter_rules())]
     for prefix, currentClass, i in iter(iterableRules):
         for rule in i:
-            converted = dumpRule(currentClass, rule, prefix)
+            converted = dumpRule(currentClass, rule, prefix, document)
             if converted.branch:
                 continue
 
-            if converted.subKlein:
+            if converted.subKlein and descend and _mayContain(converted.rulePath, pathPrefix):
                 clsDown = namedAny(converted.subKlein)
                 iterableRules.append((converted.rulePath, clsDown, clsDown.app.url_map.iter_rules()))
 
             yield converted
 
 
+def _index(items, filt, reverse):
+    """
+    -> the ConvertedRules among items whose urls are selected, sorted by (path, operationId)
+    """
+    index = []
+    for item in items:
+        if item.subKlein:
+            continue
+
+        matched = filt.search(item.rulePath)
+        matched = not matched if reverse else matched
+        if matched:
+            index.append(item)
+
+    index.sort(key=lambda item: (item.rulePath, item.operationId))
+    return index
+
+
+def _mergePaths(pairs):
+    """
+    Merge the OpenAPIPathItems of each path in pairs, (path, OpenAPIPathItem) sorted by path
+
+    -> generate (path, OpenAPIPathItem), one for each path
+    """
+    for pathPath, group in itertools.groupby(pairs, operator.itemgetter(0)):
+        pathItem = None
+        for _, other in group:
+            if pathItem is None:
+                pathItem = other
+            else:
+                pathItem.merge(other)
+        yield pathPath, pathItem
+
+
+def _pathItems(index, docCache):
+    """
+    Document the ConvertedRules of index, sorted by path, one path at a time
+
+    -> generate (path, OpenAPIPathItem), one for each path
+    """
+    return _mergePaths(item.documented(docCache).toOpenAPIPath() for item in index)
+
+
+def iterSpec(rootCls, filt=None, reverse=False, docCache=None, jobs=1):
+    """
+    Generate (path, OpenAPIPathItem) for all urls branching from rootCls, sorted by path
+
+    Apply optional filt, a regular expression, to select urls, or with reverse=True, to leave them out.
+    Docstrings found in docCache, a DocCache, are not parsed again.
+
+    Only an index of the routes is kept in memory; the docstrings of a path's handlers are read
+    when that path is generated. When filt is anchored with ^, sub-apps outside the literal start
+    of filt are not visited at all.
+
+    With jobs > 1, the sub-apps are walked and documented by that many processes; see
+    _parallelPaths.
+    """
+    pathPrefix = None if reverse or not filt else literalPrefix(filt)
+    filt = re.compile(filt or '.*')
+
+    if jobs > 1:
+        paths = _parallelPaths(rootCls, filt, reverse, docCache, jobs, pathPrefix)
+    else:
+        items = _iterClass(rootCls, document=False, pathPrefix=pathPrefix)
+        paths = _pathItems(_index(items, filt, reverse), docCache)
+
+    for pathPath, pathItem in paths:
+        yield pathPath, pathItem
+
+
+def _splitTree(rootCls, jobs, pathPrefix):
+    """
+    Walk the top of the tree, one level at a time, until there are at least jobs sub-apps below
+
+    -> (ConvertedRules of the classes walked, ConvertedRules of the sub-apps below them)
+    """
+    walked = []
+    level = [('', rootCls)]
+    while True:
+        subtrees = []
+        for prefix, cls in level:
+            for item in _iterClass(cls, prefix, document=False, descend=False):
+                walked.append(item)
+                if item.subKlein and _mayContain(item.rulePath, pathPrefix):
+                    subtrees.append(item)
+
+        if not subtrees or len(subtrees) >= jobs:
+            return walked, subtrees
+        level = [(item.rulePath, namedAny(item.subKlein)) for item in subtrees]
+
+
+def _parallelPaths(rootCls, filt, reverse, docCache, jobs, pathPrefix):
+    """
+    Document the tree with a pool of jobs processes
+
+    The top of the tree is walked here, until there are enough sub-apps to keep the pool busy.
+    Each process walks and documents whole sub-apps, which it imports by name, and sends back
+    their (path, OpenAPIPathItem) sorted by path. These are merged in the same way as in one
+    process, so the spec is the same.
+
+    -> list of (path, OpenAPIPathItem), sorted by path
+    """
+    walked, subtrees = _splitTree(rootCls, jobs, pathPrefix)
+    tasks = [(item.subKlein, item.rulePath, filt, reverse, pathPrefix) for item in subtrees]
+
+    results = []
+    if tasks:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)), _initWorker, (docCache,))
+        try:
+            results = pool.map(_subtreePaths, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    pairs = list(_pathItems(_index(walked, filt, reverse), docCache))
+    for paths, added in results:
+        pairs.extend(paths)
+        if docCache is not None:
+            docCache.update(added)
+
+    # stable, so the paths of the walked classes come first, like a serial walk
+    pairs.sort(key=operator.itemgetter(0))
+    return list(_mergePaths(pairs))
+
+
+# the DocCache of a worker process of _parallelPaths
+_workerDocCache = None
+
+
+def _initWorker(docCache):
+    global _workerDocCache
+    _workerDocCache = docCache
+
+
+def _subtreePaths(task):
+    """
+    Walk and document one sub-app, in a worker process
+
+    -> (list of (path, OpenAPIPathItem), {key: entry} added to the DocCache)
+    """
+    qname, rulePath, filt, reverse, pathPrefix = task
+    items = _iterClass(namedAny(qname), rulePath, document=False, pathPrefix=pathPrefix)
+    paths = list(_pathItems(_index(items, filt, reverse), _workerDocCache))
+    added = _workerDocCache.takeAdded() if _workerDocCache is not None else {}
+    return paths, added
+
+
+def buildSpec(rootCls, filt=None, reverse=False, docCache=None, jobs=1):
+    """
+    Build the OpenAPI 3 documentation of all urls branching from rootCls
+
+    Apply optional filt, a regular expression, to select urls, or with reverse=True, to leave them out.
+    Docstrings found in docCache, a DocCache, are not parsed again. With jobs > 1, use that many
+    processes.
+
+    -> openapi.OpenAPI
+    """
+    openapi3 = openapi.OpenAPI()
+    openapi3.paths.update(iterSpec(rootCls, filt, reverse, docCache, jobs))
+    return openapi3
+
+
+def writeSpec(out, rootCls, filt=None, reverse=False, fmt='yaml', docCache=None, jobs=1):
+    """
+    Write the OpenAPI 3 documentation of all urls branching from rootCls to out, a text file
+
+    Each path is written as soon as it is built, so only one is held in memory at a time. What is
+    written is the same as the whole buildSpec() written as fmt, 'yaml' or 'json'.
+    """
+    paths = iterSpec(rootCls, filt, reverse, docCache, jobs)
+    if fmt == 'json':
+        _writeJSON(out, openapi.OpenAPI(), paths)
+    else:
+        _writeYAML(out, openapi.OpenAPI(), paths)
+
+
+class _ContinuingDumper(yamlhack.Dumper):
+    """
+    A Dumper that numbers its anchors on from lastAnchor, as if continuing an earlier dump
+
+    libyaml numbers anchors itself, so this is always the pure-Python Dumper.
+    """
+    lastAnchor = 0
+
+    def generate_anchor(self, node):
+        self.lastAnchor += 1
+        return self.ANCHOR_TEMPLATE % self.lastAnchor
+
+
+def _dumpYAML(data, lastAnchor=0):
+    """
+    Dump data like yamlhack.dump, numbering anchors from lastAnchor + 1
+
+    -> (yaml text, number of the last anchor)
+    """
+    stream = StringIO()
+    dumper = _ContinuingDumper(stream, default_flow_style=False)
+    dumper.lastAnchor = lastAnchor
+    try:
+        dumper.open()
+        dumper.represent(data)
+        dumper.close()
+    finally:
+        dumper.dispose()
+    return stream.getvalue(), dumper.lastAnchor
+
+
+def _writeYAML(out, header, paths):
+    """
+    Write the yaml of header, an OpenAPI with no paths, followed by paths
+    """
+    text, lastAnchor = _dumpYAML(header)
+    out.write(text)
+    first = True
+    for pathPath, pathItem in paths:
+        # dumped inside a paths: mapping, so it is indented and wrapped as in the whole document
+        text, lastAnchor = _dumpYAML({'paths': {pathPath: pathItem}}, lastAnchor)
+        out.write(text if first else text.split('\n', 1)[1])
+        first = False
+
+
+_JSON_PATHS_START = '{\n  "paths": {\n'
+_JSON_PATHS_END = '\n  }\n}'
+
+
+def _writeJSON(out, header, paths):
+    """
+    Write the JSON of header, an OpenAPI with no paths, followed by paths
+    """
+    text = openapi.toJSON(header).decode('utf-8')
+    # leave the header's object open
+    out.write(text[:-len('\n}')])
+    separator = ',\n  "paths": {\n'
+    for pathPath, pathItem in paths:
+        text = openapi.toJSON({'paths': {pathPath: pathItem}}).decode('utf-8')
+        out.write(separator + text[len(_JSON_PATHS_START):-len(_JSON_PATHS_END)])
+        separator = ',\n'
+    if separator == ',\n':
+        out.write('\n  }')
+    out.write('\n}')
+
+
 @click.command()
 @click.argument('classQname')
 @click.argument('filt', required=False)
 @click.option("--reverse", "-v", is_flag=True, help='Invert the filter: select URLs which do not match', default=False)
-def urltool(classqname, filt, reverse):
+@click.option("--format", "fmt", type=click.Choice(['yaml', 'json']), default='yaml', help='Output format')
+@click.option("--stream", is_flag=True, default=False, help='Write each path as soon as it is built, using less memory')
+@click.option("--output", "-o", type=click.File('w'), default='-', help='Write to this file instead of stdout')
+@click.option("--doc-cache", "docCachePath", type=click.Path(dir_okay=False),
+        help='Keep parsed docstrings in this file, and only parse the ones that changed since the last run')
+@click.option("--jobs", "-j", type=click.IntRange(1), default=1, help='Document sub-apps in this many processes')
+def urltool(classqname, filt, reverse, fmt, stream, output, docCachePath, jobs):
     """
     Dump all urls branching from a class as OpenAPI 3 documentation
 
@@ -52,27 +356,20 @@ def urltool(classqname, filt, reverse):
     Apply optional [FILT] as a regular expression searching within urls. For
     example, to match all urls beginning with api, you might use '^/api'
     """
-    filt = re.compile(filt or '.*')
-
+    docCache = DocCache.load(docCachePath) if docCachePath else None
     rootCls = namedAny(classqname)
-    rules = list(_iterClass(rootCls))
-    arr = []
-    for item in sorted(rules):
-        if item.subKlein:
-            continue
-
-        matched = filt.search(item.rulePath)
-        matched = not matched if reverse else matched
-        if matched:
-            arr.append(tuple(item.toOpenAPIPath()))
-
-    openapi3 = openapi.OpenAPI()
-    for pathPath, pathItem in arr:
-        if pathPath in openapi3.paths:
-            openapi3.paths[pathPath].merge(pathItem)
+    if stream:
+        writeSpec(output, rootCls, filt, reverse, fmt, docCache, jobs)
+    else:
+        openapi3 = buildSpec(rootCls, filt, reverse, docCache, jobs)
+        if fmt == 'json':
+            output.write(openapi.toJSON(openapi3).decode('utf-8'))
         else:
-            openapi3.paths[pathPath] = pathItem
-    print(yaml.dump(openapi3, default_flow_style=False))
+            output.write(yamlhack.dump(openapi3))
+    output.write('\n')
+
+    if docCache is not None:
+        docCache.save()
 
 
 @attr.s
@@ -86,6 +383,13 @@ class ConvertedRule(object):
     branch = attr.ib(default=False)
     methods = attr.ib(default=attr.Factory(list))
     subKlein = attr.ib(default=None)
+    handler = attr.ib(default=None, eq=False, order=False, repr=False)
+
+    def documented(self, docCache=None):
+        """
+        -> a copy of this with doco read from the handler's docstring, or from docCache
+        """
+        return attr.evolve(self, doco=OpenAPIExtendedDocumentation.fromObject(self.handler, decode=True, cache=docCache))
 
     def toOpenAPIPath(self):
         """
@@ -138,16 +442,59 @@ class OpenAPIExtendedDocumentation(Documentation):
     """
     yamlData = attr.ib(default=None)
 
+    _full = attr.ib(default=None, eq=False, repr=False)
+
+    @property
+    def full(self):
+        if self._full is None:
+            return Documentation.full.fget(self)
+        return self._full
+
     @classmethod
-    def fromObject(cls, obj, decode=None):
-        orig = Documentation.fromObject(obj, decode)
+    def fromObject(cls, obj, decode=None, cache=None):
+        """
+        Parse the docstring of obj, and merge in the metadata from openAPIDoc, if any
+
+        With a DocCache, use what was parsed from the same docstring before, if anything
+        """
+        metadata = getattr(obj, '_openAPIDoc', ())
+        docstring = obj._openAPIDocBase if metadata else obj.__doc__
+
+        cached = None
+        if cache is not None and docstring is not None:
+            cached = cache.get(docstring, decode)
+
+        if cached is not None:
+            raw, full, yamlData = cached
+            self = cls(raw, yamlData=copy.deepcopy(yamlData), full=full)
+        else:
+            self = cls._parse(docstring, decode)
+            if cache is not None and docstring is not None:
+                cache.put(docstring, decode, self.raw, self.full, copy.deepcopy(self.yamlData))
+
+        for kwargs in metadata:
+            if self.yamlData is None:
+                self.yamlData = {}
+            self.yamlData.update(copy.deepcopy(kwargs))
+        return self
+
+    @classmethod
+    def _parse(cls, docstring, decode):
+        """
+        Parse a docstring, which may be None
+        """
+        if docstring is None:
+            orig = Documentation(u'' if decode else '')
+        else:
+            orig = Documentation.fromString(docstring, decode)
+
         self = cls(orig.raw)
         lines = self.raw.splitlines()
         if '---' in lines:
             n = lines.index('---')
             this, that = '\n'.join(lines[:n]), '\n'.join(lines[n:])
             self.yamlData = {}
-            for ydoc in yaml.load_all(that):
+            for ydoc in yamlhack.load_all(that):
                 assert isinstance(ydoc, dict), "only dict-like structures allowed in yaml docstrings not %r" % type(ydoc)
                 self.yamlData.update(ydoc)
         else:
@@ -156,9 +503,11 @@ class OpenAPIExtendedDocumentation(Documentation):
         return self
 
 
-def dumpRule(serviceCls, rule, prefix):
+def dumpRule(serviceCls, rule, prefix, document=True):
     """
     Create an in-between representation of the rule, so we can eventually convert it to OpenAPIPathItem with OpenAPIOperation(s)
+
+    With document=False, leave out the doco, and don't read the docstring
     """
     rulePath = prefix + rule.rule
     rulePath = re.sub('/{2,}', '/', rulePath)
@@ -184,15 +533,7 @@ def dumpRule(serviceCls, rule, prefix):
     if hasattr(meth, '_subKleinQname'):
         cor.subKlein = meth._subKleinQname
 
-    cor.doco = OpenAPIExtendedDocumentation.fromObject(meth, decode=True)
+    cor.handler = meth
+    if document:
+        return cor.documented()
     return cor
-
-
-def literal_unicode_representer(dumper, data):
-    """
-    Use |- literal syntax for long strings
-    """
-    if '\n' in data:
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
-    else:
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data)
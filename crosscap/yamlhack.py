@@ -1,5 +1,16 @@
 """
-Make yaml respect OrderedDicts and stop sorting things
+crosscap's own yaml Dumper and Loader, which keep the order of OrderedDicts, write long strings in
+literal style, and know how to write the OpenAPI objects
+
+The Loader is based on libyaml's CSafeLoader when PyYAML was built with libyaml, and on the
+pure-Python SafeLoader otherwise; both read the same data. The Dumper is always the pure-Python
+SafeDumper, because libyaml's emitter folds some strings differently, and the spec should be the
+same bytes whichever PyYAML is installed. Representers are only registered on these classes, so
+yaml.dump and yaml.load elsewhere in the process are not affected.
+
+    from crosscap import yamlhack
+
+    text = yamlhack.dump(spec)
 """
 from collections import OrderedDict
 import sys
@@ -10,17 +21,82 @@ import yaml
 _items = 'viewitems' if sys.version_info < (3,) else 'items'
 
 
+class Dumper(yaml.SafeDumper):
+    """
+    The Dumper crosscap uses for yaml output
+    """
+
+
+class PyLoader(yaml.SafeLoader):
+    """
+    The pure-Python Loader
+    """
+
+
+if getattr(yaml, '__with_libyaml__', False): # pragma: nocover
+    class Loader(yaml.CSafeLoader):
+        """
+        The Loader crosscap uses to read yaml in docstrings
+        """
+else: # pragma: nocover
+    Loader = PyLoader
+
+
+def add_representer(data_type, representer):
+    """
+    Register a representer for data_type with crosscap's Dumper
+    """
+    Dumper.add_representer(data_type, representer)
+
+
+def dump(data, dumper=Dumper):
+    """
+    -> data as block-style yaml
+    """
+    return yaml.dump(data, Dumper=dumper, default_flow_style=False)
+
+
+def load_all(stream):
+    """
+    Generate the documents in a yaml stream
+    """
+    return yaml.load_all(stream, Loader=Loader)
+
+
 def map_representer(dumper, data):
     return dumper.represent_dict(getattr(data, _items)())
 
 
+def sequence_representer(dumper, data):
+    return dumper.represent_list(list(data))
+
+
+def literal_unicode_representer(dumper, data):
+    """
+    Use |- literal syntax for long strings
+    """
+    if '\n' in data:
+        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
+    else:
+        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data)
+
+
 def map_constructor(loader, node): # pragma: nocover (python 3.6 doesn't use it)
     loader.flatten_mapping(node)
     return OrderedDict(loader.construct_pairs(node))
 
 
-yaml.add_representer(dict, map_representer)
-yaml.add_representer(OrderedDict, map_representer)
+add_representer(dict, map_representer)
+add_representer(OrderedDict, map_representer)
+add_representer(tuple, sequence_representer)
+
+if sys.version_info.major == 3: # pragma: nocover
+    add_representer(str, literal_unicode_representer)
+else: # pragma: nocover
+    add_representer(type(u''), literal_unicode_representer)
+
+add_representer(bytes, literal_unicode_representer)
 
 if sys.version_info < (3, 6): # pragma: nocover
-    yaml.add_constructor('tag:yaml.org,2002:map', map_constructor)
+    for _loader in {Loader, PyLoader}:
+        _loader.add_constructor(u'tag:yaml.org,2002:map', map_constructor)
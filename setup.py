@@ -24,6 +24,7 @@ cfg = dict(
     extras_require={
         # tests
         'dev': [
+            "cryptography",
             "pytest-cov",
             "pytest-twisted",
             "pytest",